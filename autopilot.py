@@ -0,0 +1,451 @@
+"""Autopilots that play the game by themselves, for demos and as a throughput/correctness soak test of the engine.
+
+An autopilot is called once per tick as `autopilot(snake) -> move` (like the policies in `benchmark.py`) and only
+reads the `Snake` it is given, so it can drive a `Game` (`Game(..., autopilot=...)`) or a bare `Snake` (`play_game`).
+Both keep what they worked out between ticks and only search again when they have to:
+
+- `PathfindingAutopilot` takes the shortest path to the apple, but only if the snake could still reach its own tail
+  right after eating it; otherwise it chases its tail until the apple is safe. That check is a heuristic, not a
+  guarantee: it usually fills most of the board, but it can still get trapped or chase its tail forever.
+  The path is reused until the snake leaves it, and the distance field it was read from until the apple moves.
+- `HamiltonianAutopilot` follows a cycle through every cell, which always wins, and takes shortcuts across the
+  cycle towards the apple while that can't trap the snake. The cycle order is computed once per board size.
+
+    python autopilot.py                                     # a 64x64 game with shortcuts
+    python autopilot.py --solver a-star --board-size 32 32 --games 10
+"""
+import argparse
+import heapq
+import os
+import time
+from collections import deque
+from itertools import count
+from pathlib import Path
+
+from game_module import import_game_module
+from snake_state import ACTIONS, ACTION_TO_ID, ACTION_DELTAS
+
+SOLVERS = ('hamiltonian', 'bfs', 'a-star')
+SHORTCUT_SLACK = 3  # free cells kept between the head and the tail (along the cycle) when taking a shortcut
+MAX_SHORTCUT_FILL = 0.5  # no more shortcuts once the snake covers this fraction of the board
+MAX_IDLE_LAPS = 2  # `play_game` gives up after this many times the number of cells in moves without eating
+
+
+def make_hamiltonian_cycle(board_size) -> list:
+    """A cycle through every cell: along the top row, zig-zag down over columns 1+, then back up column 0.
+    Boards with an odd height use the same cycle transposed; there is no cycle if both sides are odd."""
+    width, height = board_size
+    if height % 2 == 1:
+        if width % 2 == 1:
+            raise ValueError(f'There is no Hamiltonian cycle on a {width}x{height} board (both sides are odd)')
+        return [(x, y) for y, x in make_hamiltonian_cycle((height, width))]
+    cycle = [(x, 0) for x in range(width)]
+    for y in range(1, height):
+        xs = range(width - 1, 0, -1) if y % 2 == 1 else range(1, width)
+        cycle += [(x, y) for x in xs]
+    cycle += [(0, y) for y in range(height - 1, 0, -1)]
+    return cycle
+
+
+def make_neighbours(board_size) -> list:
+    """`neighbours[cell]` lists the `(action id, cell)` moves out of every flat cell (`x * height + y`)"""
+    width, height = board_size
+    neighbours = []
+    for x in range(width):
+        for y in range(height):
+            neighbours.append([(action_id, (x + delta_x) * height + y + delta_y)
+                               for action_id, (delta_x, delta_y) in enumerate(ACTION_DELTAS)
+                               if 0 <= x + delta_x < width and 0 <= y + delta_y < height])
+    return neighbours
+
+
+def get_snake_cells(snake) -> list:
+    """Flat cells of the snake, tail first and head last"""
+    height = snake.board.shape[-1]
+    return [x * height + y for x, y in snake.body_locations] + [snake.head_location[0] * height + snake.head_location[1]]
+
+
+def get_reverse_action(snake):
+    """The action id `Snake.update_from_new_move` would reject as a reversal, or None before the first move"""
+    return None if snake.previous_move is None else (ACTION_TO_ID[snake.previous_move] + 2) % 4
+
+
+class PathfindingAutopilot():
+    """Greedy shortest path to the apple, with a check that the snake can still reach its tail afterwards.
+
+    Searches are time-aware: the part of the body `i` cells from the tail has moved away `i + 2` ticks from now
+    (the tail still counts as the head moves in, see `Snake.check_for_death`), so paths can run through the
+    body where it will be gone by the time the head gets there.
+
+    Paths to the apple are read off a distance field (BFS out from the apple), which is kept until the apple moves
+    and only worked out again when the way it gives is blocked, so a snake that left its path (e.g. the player
+    steered, or it stalled) doesn't search again. Where the field can't see a way, the A* search
+    (`use_a_star=True`) or BFS from the head is tried instead.
+
+    The safety check only looks at the snake as it is when the apple is eaten. Apples that turn up on the way to the
+    tail after that can still trap it, so this is a heuristic: it doesn't win every game, and it can stall, chasing
+    its tail without ever getting to the apple (`play_game` and `Game` give up on it after `MAX_IDLE_LAPS`).
+    """
+
+    def __init__(self, use_a_star=False) -> None:
+        self.use_a_star = use_a_star
+        self.board_size = None
+        self.neighbours = None
+        self.path = deque()  # planned cells for the head to move to, next one first
+        self.path_apple = None  # the apple location `path` leads to
+        self.expected_head = None  # where the head is if the snake has kept to `path`
+        self.apple_distances = None  # moves from every cell to the apple at `distance_apple` (see `make_distance_field`)
+        self.distance_apple = None
+        self.n_searches = 0
+        return None
+
+    def reset(self):
+        self.clear_path()
+        self.apple_distances = None
+        self.distance_apple = None
+        return None
+
+    def clear_path(self):
+        self.path.clear()
+        self.path_apple = None
+        self.expected_head = None
+        return None
+
+    def __call__(self, snake) -> str:
+        board_size = tuple(snake.board.shape[1:])
+        if board_size != self.board_size:
+            self.board_size = board_size
+            self.neighbours = make_neighbours(board_size)
+            self.reset()
+        height = board_size[1]
+        head_cell = snake.head_location[0] * height + snake.head_location[1]
+
+        # keep to the planned path while it still leads to the apple and nothing has got in its way
+        if (self.path and self.path_apple == snake.apple_location and self.expected_head == head_cell
+                and not snake.occupancy[divmod(self.path[0], height)]):
+            return self._move_to(head_cell, self.path.popleft())
+
+        self.clear_path()
+        snake_cells = get_snake_cells(snake)
+        apple_cell = snake.apple_location[0] * height + snake.apple_location[1]
+        reverse_action = get_reverse_action(snake)
+        path = None
+        if self.distance_apple == snake.apple_location:
+            path = self.follow_distance_field(snake_cells, reverse_action)
+        if path is None:
+            # a new apple, or the way the field gives is blocked now
+            self.apple_distances = self.make_distance_field(snake_cells, apple_cell)
+            self.distance_apple = snake.apple_location
+            path = self.follow_distance_field(snake_cells, reverse_action)
+        if path is None:
+            # the field only lets the head through the body where it surely can, the search knows exactly when
+            path = self.find_path(snake_cells, reverse_action, apple_cell)
+        if path is not None and self._is_safe_after(snake_cells, path):
+            self.path.extend(path)
+            self.path_apple = snake.apple_location
+            return self._move_to(head_cell, self.path.popleft())
+        return self._stall(snake, snake_cells, reverse_action, apple_cell)
+
+    def _move_to(self, head_cell, next_cell) -> str:
+        self.expected_head = next_cell
+        for action_id, cell in self.neighbours[head_cell]:
+            if cell == next_cell:
+                return ACTIONS[action_id]
+        raise ValueError(f'Cell {next_cell} is not next to the head ({head_cell})')
+
+    def make_distance_field(self, snake_cells, goal_cell) -> list:
+        """Moves from every cell to `goal_cell` (None where it can't be reached). The body is only passed through
+        where it is at least as many moves from the head as it takes to move away, so the field stays right for a
+        head that walks down it, and mostly for one that has wandered off since."""
+        self.n_searches += 1
+        height = self.board_size[1]
+        head_x, head_y = divmod(snake_cells[-1], height)
+        unlock_ticks = {cell: idx + 2 for idx, cell in enumerate(snake_cells)}
+        distances = [None] * len(self.neighbours)
+        distances[goal_cell] = 0
+        queue = deque([goal_cell])
+        while queue:
+            cell = queue.popleft()
+            for _, next_cell in self.neighbours[cell]:
+                if distances[next_cell] is not None:
+                    continue
+                if next_cell in unlock_ticks:
+                    x, y = divmod(next_cell, height)
+                    if abs(x - head_x) + abs(y - head_y) < unlock_ticks[next_cell]:
+                        continue
+                distances[next_cell] = distances[cell] + 1
+                queue.append(next_cell)
+        return distances
+
+    def follow_distance_field(self, snake_cells, reverse_action):
+        """The cells from the head down `apple_distances` to the apple, or None if the field gives no way there
+        that is clear of the body by the time the head gets to each cell"""
+        unlock_ticks = {cell: idx + 2 for idx, cell in enumerate(snake_cells)}
+        path = []
+        cell, distance = snake_cells[-1], None
+        while distance != 0:
+            next_cell, next_distance = None, None
+            for action_id, neighbour in self.neighbours[cell]:
+                neighbour_distance = self.apple_distances[neighbour]
+                if (neighbour_distance is None or (not path and action_id == reverse_action)
+                        or unlock_ticks.get(neighbour, 0) > len(path) + 1):
+                    continue
+                if next_distance is None or neighbour_distance < next_distance:
+                    next_cell, next_distance = neighbour, neighbour_distance
+            if next_cell is None or (distance is not None and next_distance != distance - 1):
+                return None
+            path.append(next_cell)
+            cell, distance = next_cell, next_distance
+        return path
+
+    def find_path(self, snake_cells, reverse_action, goal_cell=None):
+        """Shortest list of cells from the head (`snake_cells[-1]`) to `goal_cell`, or None if there is none.
+        Without a `goal_cell` the goal is any part of the body, once it has moved away: from there on the head can
+        follow its own body forever (each next part of it has moved away by then too), which is what makes a move safe."""
+        self.n_searches += 1
+        height = self.board_size[1]
+        unlock_ticks = {cell: idx + 2 for idx, cell in enumerate(snake_cells)}
+        goal_cells = unlock_ticks if goal_cell is None else (goal_cell,)
+        goal_x, goal_y = divmod(snake_cells[0] if goal_cell is None else goal_cell, height)
+
+        def heuristic(cell):
+            if not self.use_a_star or goal_cell is None:
+                return 0  # plain BFS (the heap then pops in order of distance)
+            x, y = divmod(cell, height)
+            return abs(x - goal_x) + abs(y - goal_y)
+
+        start_cell = snake_cells[-1]
+        tie_breaker = count()
+        frontier = [(heuristic(start_cell), next(tie_breaker), 0, start_cell)]
+        came_from = {start_cell: None}
+        best_ticks = {start_cell: 0}
+        while frontier:
+            _, _, ticks, cell = heapq.heappop(frontier)
+            if cell in goal_cells and ticks > 0:
+                path = []
+                while cell != start_cell:
+                    path.append(cell)
+                    cell = came_from[cell]
+                return path[::-1]
+            if ticks > best_ticks[cell]:
+                continue  # a shorter way here was found after this one was queued
+            for action_id, next_cell in self.neighbours[cell]:
+                if ticks == 0 and action_id == reverse_action:
+                    continue
+                if unlock_ticks.get(next_cell, 0) > ticks + 1 or best_ticks.get(next_cell, ticks + 2) <= ticks + 1:
+                    continue
+                best_ticks[next_cell] = ticks + 1
+                came_from[next_cell] = cell
+                heapq.heappush(frontier, (ticks + 1 + heuristic(next_cell), next(tie_breaker), ticks + 1, next_cell))
+        return None
+
+    def _is_safe_after(self, snake_cells, path) -> bool:
+        """Whether the snake could still reach its tail after following `path` and eating the apple at its end"""
+        n_cells = len(self.neighbours)
+        new_length = len(snake_cells) + 1
+        if new_length == n_cells:
+            return True  # that was the last apple
+        new_snake_cells = (snake_cells + path)[-new_length:]
+        return self.find_path(new_snake_cells, self._get_reverse_action(new_snake_cells)) is not None
+
+    def _stall(self, snake, snake_cells, reverse_action, apple_cell) -> str:
+        """Buys time without eating: heads for the tail along the longest of the shortest ways there (and keeps to
+        that path like to one to the apple), or failing that moves into the largest open area"""
+        best_action_id, best_next_cell, best_score, best_tail_path = None, None, None, None
+        for action_id, next_cell in self.neighbours[snake_cells[-1]]:
+            if action_id == reverse_action or next_cell in snake_cells:
+                continue
+            is_growing = next_cell == apple_cell
+            new_snake_cells = snake_cells[0 if is_growing else 1:] + [next_cell]
+            tail_path = self.find_path(new_snake_cells, (action_id + 2) % 4)
+            if tail_path is not None:
+                # a way past the apple would have to stop short of it (see below), and might get stuck there
+                score = (2 if apple_cell not in tail_path else 1, len(tail_path))
+            else:
+                score = (0, self._count_reachable(next_cell, set(new_snake_cells)))
+            if best_score is None or score > best_score:
+                best_action_id, best_next_cell, best_score, best_tail_path = action_id, next_cell, score, tail_path
+        if best_action_id is None:
+            # with no way out, keep going straight (and die)
+            return ACTIONS[(reverse_action + 2) % 4] if reverse_action is not None else ACTIONS[0]
+        self.expected_head = best_next_cell
+        if best_tail_path is not None:
+            # stop short of the apple: eating it along the way would make the rest of the path unsafe
+            if apple_cell in best_tail_path:
+                best_tail_path = best_tail_path[:best_tail_path.index(apple_cell)]
+            self.path.extend(best_tail_path)
+            self.path_apple = snake.apple_location
+        return ACTIONS[best_action_id]
+
+    def _count_reachable(self, start_cell, blocked_cells) -> int:
+        seen = {start_cell}
+        stack = [start_cell]
+        while stack:
+            for _, next_cell in self.neighbours[stack.pop()]:
+                if next_cell not in seen and next_cell not in blocked_cells:
+                    seen.add(next_cell)
+                    stack.append(next_cell)
+        return len(seen)
+
+    def _get_reverse_action(self, snake_cells):
+        """`get_reverse_action` for a snake given by its cells: the move from the head back to the neck"""
+        if len(snake_cells) < 2:
+            return None
+        for action_id, cell in self.neighbours[snake_cells[-1]]:
+            if cell == snake_cells[-2]:
+                return action_id
+        return None
+
+
+class HamiltonianAutopilot():
+    """Follows a Hamiltonian cycle, taking shortcuts towards the apple while the snake is short.
+
+    As long as the whole snake lies along the cycle between its tail and its head, the cells ahead of the head
+    (up to the tail) are free. A shortcut skips some of them, so it is only taken if it stays ahead of the tail by
+    `SHORTCUT_SLACK` cells (more when the snake is about to grow) and doesn't go past the apple. Once the snake fills `max_shortcut_fill` of the board it
+    just follows the cycle, which can't fail.
+    """
+
+    def __init__(self, shortcuts=True, max_shortcut_fill=MAX_SHORTCUT_FILL) -> None:
+        self.shortcuts = shortcuts
+        self.max_shortcut_fill = max_shortcut_fill
+        self.board_size = None
+        self.neighbours = None
+        self.cycle_cells = None  # flat cells in cycle order
+        self.cycle_positions = None  # flat cell -> position in the cycle
+        self.n_shortcuts = 0
+        return None
+
+    def __call__(self, snake) -> str:
+        board_size = tuple(snake.board.shape[1:])
+        if board_size != self.board_size:
+            self.board_size = board_size
+            self.neighbours = make_neighbours(board_size)
+            self.cycle_cells = [x * board_size[1] + y for x, y in make_hamiltonian_cycle(board_size)]
+            self.cycle_positions = [0] * len(self.cycle_cells)
+            for position, cell in enumerate(self.cycle_cells):
+                self.cycle_positions[cell] = position
+        height = board_size[1]
+        n_cells = len(self.cycle_cells)
+        head_cell = snake.head_location[0] * height + snake.head_location[1]
+        head_position = self.cycle_positions[head_cell]
+        reverse_action = get_reverse_action(snake)
+
+        max_jump = 1  # the next cell along the cycle
+        if self.shortcuts and len(snake.body_locations) + 1 < self.max_shortcut_fill * n_cells:
+            tail_location = snake.body_locations[0] if snake.body_locations else snake.head_location
+            tail_cell = tail_location[0] * height + tail_location[1]
+            tail_distance = (self.cycle_positions[tail_cell] - head_position) % n_cells or n_cells
+            apple_cell = snake.apple_location[0] * height + snake.apple_location[1]
+            apple_distance = (self.cycle_positions[apple_cell] - head_position) % n_cells
+            n_free_cells = n_cells - len(snake.body_locations) - 1
+            # the snake grows by one when it eats, which the tail has to stay ahead of
+            max_tail_jump = tail_distance - 1 - SHORTCUT_SLACK
+            if apple_distance < tail_distance:
+                max_tail_jump -= 1
+                if (tail_distance - apple_distance) * 4 > n_free_cells:
+                    # the next apple has a fair chance of turning up right in front of the head as well
+                    max_tail_jump -= 10
+            max_jump = max(min(apple_distance, max_tail_jump), 1)
+
+        best_action, best_jump = None, 0
+        for action_id, next_cell in self.neighbours[head_cell]:
+            jump = (self.cycle_positions[next_cell] - head_position) % n_cells
+            if action_id == reverse_action or jump > max_jump or jump <= best_jump:
+                continue
+            if snake.occupancy[divmod(next_cell, height)]:
+                continue
+            best_action, best_jump = action_id, jump
+        if best_action is None:
+            # the snake is not where the cycle expects it to be (e.g. someone else steered), head along the cycle
+            next_cell = self.cycle_cells[(head_position + 1) % n_cells]
+            return ACTIONS[next(action_id for action_id, cell in self.neighbours[head_cell] if cell == next_cell)]
+        if best_jump > 1:
+            self.n_shortcuts += 1
+        return ACTIONS[best_action]
+
+
+def make_autopilot(solver='hamiltonian'):
+    """One of `SOLVERS` by name"""
+    if solver == 'hamiltonian':
+        return HamiltonianAutopilot()
+    if solver == 'bfs':
+        return PathfindingAutopilot()
+    if solver == 'a-star':
+        return PathfindingAutopilot(use_a_star=True)
+    raise ValueError(f'Unknown solver {solver!r}, expected one of {SOLVERS}')
+
+
+def play_game(snake, autopilot, max_moves=None, check_every=0, strict=True) -> int:
+    """Lets `autopilot` play `snake` headlessly until the game ends, `max_moves` moves were made, or it goes
+    `MAX_IDLE_LAPS` board sizes' worth of moves without eating (a pathfinder can end up chasing its tail forever).
+    Every `check_every` moves (if not 0) the engine's bookkeeping is checked with `check_invariants`.
+    An invalid move raises an AssertionError, or with `strict=False` keeps the snake going straight (as in `Game`).
+    Returns the number of moves made."""
+    max_idle_moves = MAX_IDLE_LAPS * snake.occupancy.size
+    n_moves = 0
+    last_meal_move, last_length = 0, len(snake.body_locations)
+    while snake.is_alive and not snake.has_won and (max_moves is None or n_moves < max_moves):
+        if not snake.update_from_new_move(autopilot(snake)):
+            if strict:
+                raise AssertionError(f'Move {n_moves}: the autopilot made an invalid move')
+            snake.update_from_new_move(snake.previous_move)
+        n_moves += 1
+        if check_every and (n_moves % check_every == 0 or snake.has_won):
+            check_invariants(snake)
+        if len(snake.body_locations) != last_length:
+            last_meal_move, last_length = n_moves, len(snake.body_locations)
+        elif n_moves - last_meal_move >= max_idle_moves:
+            break
+    return n_moves
+
+
+def check_invariants(snake):
+    """Raises an AssertionError if the snake's derived state (occupancy, free cells, body) is inconsistent"""
+    height = snake.board.shape[-1]
+    snake_locations = [*snake.body_locations, snake.head_location]
+    assert len(set(snake_locations)) == len(snake_locations), 'the snake overlaps itself'
+    for location, next_location in zip(snake_locations, snake_locations[1:]):
+        assert abs(location[0] - next_location[0]) + abs(location[1] - next_location[1]) == 1, \
+            f'the body is broken between {location} and {next_location}'
+    assert int(snake.occupancy.sum()) == len(snake_locations), 'the occupancy grid does not match the snake'
+    assert all(snake.occupancy[location] for location in snake_locations), 'the occupancy grid does not match the snake'
+    assert len(snake.free_cells) + len(snake_locations) == snake.occupancy.size, 'the free cells do not add up'
+    for position, cell in enumerate(snake.free_cells):
+        assert snake.free_cell_positions[cell] == position, f'free cell {cell} is indexed at the wrong position'
+        assert not snake.occupancy[divmod(cell, height)], f'free cell {cell} is occupied'
+    assert snake.has_won or not snake.occupancy[snake.apple_location], 'the apple is under the snake'
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--solver', default='hamiltonian', help=f"one of {', '.join(SOLVERS)}")
+    parser.add_argument('--board-size', type=int, nargs=2, default=(64, 64), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--games', type=int, default=1, help='number of games to play')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the first game (then +1 per game)')
+    parser.add_argument('--max-moves', type=int, default=None, help='stop a game after this many moves')
+    parser.add_argument('--check-every', type=int, default=1000,
+                        help='check the engine bookkeeping every this many moves (0 to never check)')
+    args = parser.parse_args()
+    if args.solver not in SOLVERS:
+        parser.error(f"unknown solver {args.solver!r}, expected one of {', '.join(SOLVERS)}")
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    snake_game = import_game_module()
+    sprite_location = Path(__file__).with_name('snake-sprites.png')
+    autopilot = make_autopilot(args.solver)
+    for game_idx in range(args.games):
+        snake = snake_game.Snake(board_size=args.board_size, random_seed=args.seed + game_idx,
+                                 sprite_location=sprite_location)
+        start_time = time.perf_counter()
+        n_moves = play_game(snake, autopilot, max_moves=args.max_moves, check_every=args.check_every)
+        seconds = time.perf_counter() - start_time
+        result = 'won' if snake.has_won else 'died' if not snake.is_alive else 'stopped'
+        print(f'game {game_idx}: {result} with a score of {len(snake.body_locations) + 1}/{snake.occupancy.size} '
+              f'after {n_moves:,} moves in {seconds:.1f}s ({n_moves / max(seconds, 1e-9):,.0f} moves/s)')
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Benchmarks for the snake engine (`Snake` steps) and the renderer (`Game.display_board`).
+
+Every scenario starts from a scripted position (a snake of a given length laid along a Hamiltonian cycle)
+and then follows that cycle, so the moves, apples and results are the same on every run. Rendering runs
+under SDL's dummy video driver with an uncapped clock, so no window is needed.
+
+    python benchmark.py                         # all scenarios
+    python benchmark.py long-32 board-256       # only some of them
+    python benchmark.py --json results.json     # also save the results
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+from pathlib import Path
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+import pygame
+
+from autopilot import make_hamiltonian_cycle
+from game_module import import_game_module
+
+snake_game = import_game_module()
+
+SPRITE_PATH = Path(__file__).with_name('snake-sprites.png')
+SPRITE_SIZE = (16, 16)
+
+# name -> (board size, starting snake length)
+SCENARIOS = {
+    'short-16': ((16, 16), 4),
+    'long-32': ((32, 32), 512),
+    'near-full-32': ((32, 32), 1000),
+    'board-16': ((16, 16), 64),
+    'board-32': ((32, 32), 64),
+    'board-64': ((64, 64), 64),
+    'board-128': ((128, 128), 64),
+    'board-256': ((256, 256), 64),
+}
+
+
+def make_cycle_policy(cycle):
+    """Returns a `policy(snake) -> move` that follows `cycle`, which never dies and eventually fills the board"""
+    moves_by_delta = {delta: move for move, delta in snake_game.MOVE_DELTAS.items()}
+    next_moves = {}
+    for location, next_location in zip(cycle, cycle[1:] + cycle[:1]):
+        next_moves[location] = moves_by_delta[(next_location[0] - location[0], next_location[1] - location[1])]
+    return lambda snake: next_moves[snake.head_location]
+
+
+def make_scenario_keyframe(snake, cycle, length) -> dict:
+    """A keyframe (see `Snake.make_keyframe`) of a `length` long snake laid along `cycle`, tail first"""
+    height = snake.board.shape[-1]
+    snake_cells = cycle[:length]
+    occupied = {x * height + y for x, y in snake_cells}
+    free_cells = [cell for cell in range(snake.occupancy.size) if cell not in occupied]
+    head, neck = snake_cells[-1], snake_cells[-2]
+    moves_by_delta = {delta: move for move, delta in snake_game.MOVE_DELTAS.items()}
+    return dict(head_location=head,
+                body_locations=snake_cells[:-1],
+                apple_location=divmod(free_cells[len(free_cells) // 2], height),
+                previous_move=moves_by_delta[(head[0] - neck[0], head[1] - neck[1])],
+                free_cells=free_cells,
+                rng_state=snake.rng.get_state(),
+                is_alive=True,
+                has_won=False)
+
+
+def make_scenario_snake(board_size, length):
+    snake = snake_game.Snake(board_size=board_size, random_seed=0, sprite_location=SPRITE_PATH, sprite_size=SPRITE_SIZE)
+    cycle = make_hamiltonian_cycle(board_size)
+    keyframe = make_scenario_keyframe(snake, cycle, length)
+    snake.load_keyframe(keyframe)
+    return snake, keyframe, make_cycle_policy(cycle)
+
+
+def make_scenario_game(board_size, length):
+    snake, keyframe, policy = make_scenario_snake(board_size, length)
+    screen = pygame.display.set_mode((board_size[0] * SPRITE_SIZE[0],
+                                      board_size[1] * SPRITE_SIZE[1] + snake_game.HEADER_HEIGHT_OFFSET))
+    game = snake_game.Game(snake, screen, uncapped_clock=True)
+    return game, keyframe, policy
+
+
+def benchmark_steps(board_size, length, n_steps) -> float:
+    """Engine only: `Snake.update_from_new_move` steps per second"""
+    snake, keyframe, policy = make_scenario_snake(board_size, length)
+    start_time = time.perf_counter()
+    for _ in range(n_steps):
+        snake.update_from_new_move(policy(snake))
+        if snake.has_won:
+            snake.load_keyframe(keyframe)
+    return n_steps / (time.perf_counter() - start_time)
+
+
+def benchmark_frames(board_size, length, n_frames) -> float:
+    """Full game loop (score, dirty-rect rendering and a move): frames per second"""
+    game, keyframe, policy = make_scenario_game(board_size, length)
+    n_played = 0
+    start_time = time.perf_counter()
+    while n_played < n_frames:
+        n_played += game.fast_forward(policy(game.snake) for _ in range(n_frames - n_played))
+        if game.snake.has_won:
+            game.snake.load_keyframe(keyframe)
+            game.board_renderer.invalidate()
+    return n_frames / (time.perf_counter() - start_time)
+
+
+def benchmark_composites(board_size, length, n_frames) -> float:
+    """Offline rendering: `Snake.prepare_board_for_displaying` frames per second"""
+    snake, _, _ = make_scenario_snake(board_size, length)
+    image_size = [board_size[0] * SPRITE_SIZE[0], board_size[1] * SPRITE_SIZE[1]]
+    start_time = time.perf_counter()
+    for _ in range(n_frames):
+        snake.prepare_board_for_displaying(image_size)
+    return n_frames / (time.perf_counter() - start_time)
+
+
+def measure_peak_memory(board_size, length, n_frames) -> int:
+    """Peak traced allocation (bytes) while setting up a game and playing `n_frames` frames"""
+    tracemalloc.start()
+    try:
+        game, _, policy = make_scenario_game(board_size, length)
+        game.fast_forward(policy(game.snake) for _ in range(n_frames))
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(scenario_names, n_steps, n_frames) -> dict:
+    results = {}
+    for name in scenario_names:
+        board_size, length = SCENARIOS[name]
+        results[name] = dict(
+            board_size=list(board_size),
+            snake_length=length,
+            steps_per_second=benchmark_steps(board_size, length, n_steps),
+            frames_per_second=benchmark_frames(board_size, length, n_frames),
+            composites_per_second=benchmark_composites(board_size, length, max(n_frames // 10, 1)),
+            peak_memory_bytes=measure_peak_memory(board_size, length, max(n_frames // 10, 1)),
+        )
+        print_result(name, results[name])
+    return results
+
+
+def print_result(name, result):
+    print(f"{name:>14}  {result['steps_per_second']:>12,.0f} steps/s  {result['frames_per_second']:>10,.0f} frames/s"
+          f"  {result['composites_per_second']:>10,.0f} composites/s  {result['peak_memory_bytes'] / 2**20:>8.1f} MiB peak")
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument('--steps', type=int, default=100_000, help='engine steps per scenario')
+    parser.add_argument('--frames', type=int, default=2_000, help='rendered frames per scenario')
+    parser.add_argument('--json', type=Path, default=None, help='also write the results to this file')
+    args = parser.parse_args()
+    unknown_scenarios = set(args.scenarios) - set(SCENARIOS)
+    if unknown_scenarios:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown_scenarios))}")
+
+    pygame.init()
+    results = run_benchmarks(args.scenarios or list(SCENARIOS), args.steps, args.frames)
+    pygame.quit()
+    if args.json is not None:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""Every finished game, kept in a local SQLite database (in WAL mode) that is only ever appended to.
+
+`GameHistory.add(record)` queues a record (see `GAME_FIELDS`) and returns right away. A writer thread inserts
+whatever is queued in one transaction per batch, so the game loop never waits on the disk and a crash can lose
+the games that were still queued, but never corrupt the ones that were written.
+
+Next to the `games` table, `score_counts` keeps how many games got each score on each board size. It is updated
+in the same transaction as the games, so the high score (its highest score) is always consistent with them.
+Percentiles and ranks are read from it too, so they cost the same with a thousand games as with millions (a
+board has at most width * height different scores). The leaderboard reads the top of an index of `games`.
+
+    python game_history.py game_saves/history.sqlite3 --board-size 32 32 --top 10
+"""
+import argparse
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+# how a game ended (stalled: an autopilot gave up making progress, quit: the window was closed mid-game)
+OUTCOMES = ('won', 'wall', 'self', 'stalled', 'quit')
+GAME_FIELDS = ('finished_at', 'random_seed', 'board_width', 'board_height', 'score', 'steps', 'duration_s', 'outcome',
+               'frame_ms_mean', 'frame_ms_p50', 'frame_ms_p95', 'frame_ms_p99', 'frame_ms_max')
+FRAME_MS_PERCENTILES = (50, 95, 99)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    finished_at REAL NOT NULL,  -- unix time
+    random_seed INTEGER NOT NULL,
+    board_width INTEGER NOT NULL,
+    board_height INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    steps INTEGER NOT NULL,
+    duration_s REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    frame_ms_mean REAL,  -- frame times are NULL for games that were played headless
+    frame_ms_p50 REAL,
+    frame_ms_p95 REAL,
+    frame_ms_p99 REAL,
+    frame_ms_max REAL
+);
+CREATE INDEX IF NOT EXISTS games_by_score ON games (board_width, board_height, score DESC, steps);
+CREATE TABLE IF NOT EXISTS score_counts (
+    board_width INTEGER NOT NULL,
+    board_height INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    n_games INTEGER NOT NULL,
+    PRIMARY KEY (board_width, board_height, score)
+) WITHOUT ROWID;
+"""
+_INSERT_GAME = f"INSERT INTO games ({', '.join(GAME_FIELDS)}) VALUES ({', '.join('?' * len(GAME_FIELDS))})"
+_COUNT_SCORE = """
+INSERT INTO score_counts (board_width, board_height, score, n_games) VALUES (?, ?, ?, 1)
+ON CONFLICT (board_width, board_height, score) DO UPDATE SET n_games = n_games + 1
+"""
+
+logger = logging.getLogger('snake')
+
+
+def get_outcome(snake, is_stalled=False) -> str:
+    """One of `OUTCOMES` for a game that stopped, whether it ended or was given up on (`is_stalled`) or quit"""
+    if snake.has_won:
+        return 'won'
+    if snake.is_alive:
+        return 'stalled' if is_stalled else 'quit'
+    return 'self' if snake.is_on_board(snake.head_location) else 'wall'
+
+
+def summarize_frame_times(frame_ms_counts) -> dict:
+    """Mean, percentiles and max of a game's frame times, from `frame_ms_counts[ms]` = number of frames that
+    took `ms` milliseconds (the last bin counts every longer frame too). Empty (all None) if no frame was drawn."""
+    frame_ms_counts = np.asarray(frame_ms_counts)
+    n_frames = frame_ms_counts.sum()
+    if n_frames == 0:
+        return dict(frame_ms_mean=None, frame_ms_p50=None, frame_ms_p95=None, frame_ms_p99=None, frame_ms_max=None)
+    frame_ms = np.arange(len(frame_ms_counts))
+    cumulative = np.cumsum(frame_ms_counts)
+    summary = dict(frame_ms_mean=float((frame_ms_counts * frame_ms).sum() / n_frames))
+    for percentile in FRAME_MS_PERCENTILES:
+        summary[f'frame_ms_p{percentile}'] = float(np.searchsorted(cumulative, percentile / 100 * n_frames))
+    summary['frame_ms_max'] = float(frame_ms[frame_ms_counts > 0][-1])
+    return summary
+
+
+def connect(database_path) -> sqlite3.Connection:
+    connection = sqlite3.connect(database_path, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')  # in WAL mode, a power cut can only lose the last commits
+    return connection
+
+
+class GameHistory():
+    """The games stored in `database_path`. Records are written by a background thread in batches of up to
+    `batch_size`; `flush()` waits until everything added so far is written, and `close()` also stops the thread."""
+
+    def __init__(self, database_path, batch_size=1000) -> None:
+        self.database_path = Path(database_path)
+        self.database_path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.connection = connect(self.database_path)  # for the queries, on the thread that made the history
+        self.connection.executescript(SCHEMA)
+        self.pending_records = queue.Queue()
+        self.writer_thread = threading.Thread(target=self._write_records, name='game-history-writer', daemon=True)
+        self.writer_thread.start()
+        return None
+
+    def add(self, record: dict):
+        """Queues one game (a dict with every field of `GAME_FIELDS`) to be written"""
+        self.pending_records.put(tuple(record[field] for field in GAME_FIELDS))
+        return None
+
+    def _write_records(self):
+        # sqlite connections can't be shared between threads, so the writer has its own
+        connection = connect(self.database_path)
+        is_closing = False
+        while not is_closing:
+            batch = [self.pending_records.get()]
+            while len(batch) < self.batch_size and not self.pending_records.empty():
+                batch.append(self.pending_records.get_nowait())
+            if batch[-1] is None:  # `close()` was called, and everything before it is in this batch
+                batch.pop()
+                is_closing = True
+            try:
+                with connection:  # one transaction: the games and their score counts are written together or not at all
+                    connection.executemany(_INSERT_GAME, batch)
+                    connection.executemany(_COUNT_SCORE, [(record[2], record[3], record[4]) for record in batch])
+            except sqlite3.Error as error:
+                logger.error(f'Could not save {len(batch)} games to {self.database_path}: {error}')
+            for _ in range(len(batch) + is_closing):
+                self.pending_records.task_done()
+        connection.close()
+        return None
+
+    def flush(self):
+        self.pending_records.join()
+        return None
+
+    def close(self):
+        if not self.writer_thread.is_alive():
+            return None
+        self.pending_records.put(None)
+        self.writer_thread.join()
+        self.connection.close()
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def count_games(self, board_size) -> int:
+        (n_games,), = self.connection.execute(
+            'SELECT COALESCE(SUM(n_games), 0) FROM score_counts WHERE board_width = ? AND board_height = ?', board_size)
+        return n_games
+
+    def get_high_score(self, board_size):
+        """The best score on this board size (None if no game was played on it)"""
+        (high_score,), = self.connection.execute(
+            'SELECT MAX(score) FROM score_counts WHERE board_width = ? AND board_height = ?', board_size)
+        return high_score
+
+    def get_leaderboard(self, board_size, n_games=10) -> list:
+        """The `n_games` best games on this board size (the fewest steps first on equal scores), as dicts"""
+        cursor = self.connection.execute(
+            f"SELECT {', '.join(GAME_FIELDS)} FROM games WHERE board_width = ? AND board_height = ?"
+            f" ORDER BY score DESC, steps LIMIT ?", (*board_size, n_games))
+        return [dict(zip(GAME_FIELDS, row)) for row in cursor]
+
+    def get_score_counts(self, board_size) -> tuple:
+        """`(scores, n_games)` arrays of every score reached on this board size, lowest first"""
+        rows = self.connection.execute('SELECT score, n_games FROM score_counts WHERE board_width = ? AND board_height = ?'
+                                       ' ORDER BY score', board_size).fetchall()
+        scores, n_games = np.array(rows, dtype=np.int64).reshape(-1, 2).T
+        return scores, n_games
+
+    def get_score_percentile(self, board_size, percentile):
+        """The score that `percentile`% of the games on this board size didn't beat (None if there are none)"""
+        scores, n_games = self.get_score_counts(board_size)
+        if len(scores) == 0:
+            return None
+        score_idx = np.searchsorted(np.cumsum(n_games), percentile / 100 * n_games.sum())
+        return int(scores[min(score_idx, len(scores) - 1)])
+
+    def get_rank(self, board_size, score) -> int:
+        """Where `score` would place on this board size's leaderboard (1 is first)"""
+        (n_better_games,), = self.connection.execute(
+            'SELECT COALESCE(SUM(n_games), 0) FROM score_counts WHERE board_width = ? AND board_height = ? AND score > ?',
+            (*board_size, score))
+        return n_better_games + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database', type=Path)
+    parser.add_argument('--board-size', type=int, nargs=2, default=(32, 32), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--top', type=int, default=10, help='number of games on the leaderboard')
+    args = parser.parse_args()
+    if not args.database.exists():
+        parser.error(f'{args.database} does not exist')
+
+    with GameHistory(args.database) as history:
+        board_size = tuple(args.board_size)
+        print(f"{history.count_games(board_size):,} games on {board_size[0]}x{board_size[1]}, "
+              f"median score {history.get_score_percentile(board_size, 50)}, "
+              f"90th percentile {history.get_score_percentile(board_size, 90)}")
+        for place, game in enumerate(history.get_leaderboard(board_size, args.top), start=1):
+            finished_at = time.strftime('%Y-%m-%d %H:%M', time.localtime(game['finished_at']))
+            print(f"{place:>4}. {game['score']:>6}  {game['steps']:>8,} steps  {game['duration_s']:>8.1f}s  "
+                  f"{game['outcome']:<5} seed {game['random_seed']:<10}  {finished_at}")
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+"""The game itself (`pygame-snake.py`) as a module, for the tools that drive it from other scripts."""
+import importlib
+
+
+def import_game_module():
+    """Imports `pygame-snake.py` (its name has a dash in it, so it can't be imported with a plain import statement)"""
+    return importlib.import_module('pygame-snake')
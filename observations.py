@@ -0,0 +1,145 @@
+"""Observations of a `Snake` game for learning agents, written into preallocated buffers.
+
+`SnakeObserver` encodes the game after every step in one of `ENCODINGS`:
+
+    planes       (len(PLANES), W, H)                   one 0/1 channel per entity (head, body, tail, apple)
+    egocentric   (len(CROP_PLANES), 2r + 1, 2r + 1)    body, apple and wall channels of the cells within
+                                                       `crop_radius` of the head, with the head in the middle
+    features     (len(FEATURE_NAMES),)                 a small vector of hand-made features
+
+and keeps the last `n_frames` of them in a ring buffer. Every frame is written twice, at slots `i` and
+`i + n_frames` of a `2 * n_frames` long buffer, so the latest `n_frames` are always one contiguous slice of
+it: `observe()` returns one of `n_frames` read-only views made up front, oldest frame first. Nothing is
+allocated per step and older frames are never moved. The views are overwritten by later steps, so copy them
+if they need to be kept (e.g. in a replay memory).
+"""
+import numpy as np
+
+from snake_state import ACTION_DELTAS, ACTION_TO_ID
+
+ENCODINGS = ('planes', 'egocentric', 'features')
+PLANES = ('head', 'body', 'tail', 'apple')
+CROP_PLANES = ('body', 'apple', 'wall')
+# danger_*: moving that way would kill the snake, moving_*: its current direction, apple_dx/dy: offset to the
+# apple over the board size, wall_*: cells between the head and the wall over the board size, length: the
+# fraction of the board the snake covers
+FEATURE_NAMES = ('danger_up', 'danger_right', 'danger_down', 'danger_left',
+                 'moving_up', 'moving_right', 'moving_down', 'moving_left',
+                 'apple_dx', 'apple_dy',
+                 'wall_up', 'wall_right', 'wall_down', 'wall_left',
+                 'length')
+
+
+class SnakeObserver():
+    """Encodes `snake` on every `observe()` call (once per step) into a stack of its last `n_frames` frames"""
+
+    def __init__(self, snake, encoding='planes', n_frames=1, crop_radius=5, dtype=np.float32) -> None:
+        if encoding not in ENCODINGS:
+            raise ValueError(f'Unknown encoding {encoding!r}, expected one of {ENCODINGS}')
+        self.snake = snake
+        self.encoding = encoding
+        self.n_frames = n_frames
+        self.crop_radius = crop_radius
+        self.board_size = tuple(snake.board.shape[1:])
+        width, height = self.board_size
+
+        if encoding == 'planes':
+            self.frame_shape = (len(PLANES), width, height)
+        elif encoding == 'egocentric':
+            self.frame_shape = (len(CROP_PLANES), 2 * crop_radius + 1, 2 * crop_radius + 1)
+        else:
+            self.frame_shape = (len(FEATURE_NAMES),)
+
+        self.frames = np.zeros((2 * n_frames, *self.frame_shape), dtype=dtype)
+        self.stack_views = []  # `stack_views[i]` is the stack once the newest frame is in slot `i`
+        for slot in range(n_frames):
+            stack_view = self.frames[slot + 1:slot + 1 + n_frames]
+            stack_view.flags.writeable = False
+            self.stack_views.append(stack_view)
+        self.n_observed = 0  # frames written since the last reset
+        return None
+
+    @property
+    def observation_shape(self) -> tuple:
+        return (self.n_frames, *self.frame_shape)
+
+    def reset(self) -> np.ndarray:
+        """Starts a new stack (e.g. for a new game), filled with copies of the current frame"""
+        self._write_frame(self.frames[0])
+        self.frames[1:] = self.frames[0]
+        self.n_observed = 1
+        return self.stack_views[-1]
+
+    def observe(self) -> np.ndarray:
+        """Encodes the current state as the newest frame and returns the stack (a read-only view)"""
+        if self.n_observed == 0:
+            return self.reset()
+        slot = self.n_observed % self.n_frames
+        self._write_frame(self.frames[slot])
+        self.frames[slot + self.n_frames] = self.frames[slot]
+        self.n_observed += 1
+        return self.stack_views[slot]
+
+    def _write_frame(self, frame):
+        if self.encoding == 'planes':
+            self._write_planes(frame)
+        elif self.encoding == 'egocentric':
+            self._write_crop(frame)
+        else:
+            self._write_features(frame)
+        return None
+
+    def _is_on_board(self, location) -> bool:
+        return 0 <= location[0] < self.board_size[0] and 0 <= location[1] < self.board_size[1]
+
+    def _write_planes(self, frame):
+        snake = self.snake
+        np.copyto(frame[PLANES.index('body')], snake.occupancy)
+        frame[PLANES.index('head')] = 0
+        frame[PLANES.index('tail')] = 0
+        frame[PLANES.index('apple')] = 0
+        if self._is_on_board(snake.head_location):
+            frame[PLANES.index('body')][snake.head_location] = 0
+            frame[PLANES.index('head')][snake.head_location] = 1
+        if snake.body_locations:
+            frame[PLANES.index('tail')][snake.body_locations[0]] = 1
+        frame[PLANES.index('apple')][snake.apple_location] = 1
+        return None
+
+    def _write_crop(self, frame):
+        """Fills the crop from the cells around the head only, so it costs the same on any board size"""
+        snake = self.snake
+        width, height = self.board_size
+        head_x, head_y = snake.head_location
+        radius = self.crop_radius
+        # the part of the crop that is on the board (a head that just ran into a wall is one cell off it)
+        start_x, end_x = max(head_x - radius, 0), min(head_x + radius + 1, width)
+        start_y, end_y = max(head_y - radius, 0), min(head_y + radius + 1, height)
+        on_board = (slice(start_x - head_x + radius, end_x - head_x + radius),
+                    slice(start_y - head_y + radius, end_y - head_y + radius))
+        frame[...] = 0
+        frame[CROP_PLANES.index('wall')] = 1
+        frame[CROP_PLANES.index('wall')][on_board] = 0
+        frame[CROP_PLANES.index('body')][on_board] = snake.occupancy[start_x:end_x, start_y:end_y]
+        if self._is_on_board(snake.head_location):
+            frame[CROP_PLANES.index('body'), radius, radius] = 0
+        apple_x, apple_y = snake.apple_location[0] - head_x + radius, snake.apple_location[1] - head_y + radius
+        if 0 <= apple_x <= 2 * radius and 0 <= apple_y <= 2 * radius:
+            frame[CROP_PLANES.index('apple'), apple_x, apple_y] = 1
+        return None
+
+    def _write_features(self, frame):
+        snake = self.snake
+        width, height = self.board_size
+        head_x, head_y = snake.head_location
+        frame[...] = 0
+        for action_id, (delta_x, delta_y) in enumerate(ACTION_DELTAS):
+            next_location = (head_x + delta_x, head_y + delta_y)
+            frame[action_id] = not self._is_on_board(next_location) or snake.occupancy[next_location]
+        if snake.previous_move is not None:
+            frame[4 + ACTION_TO_ID[snake.previous_move]] = 1
+        frame[8] = (snake.apple_location[0] - head_x) / width
+        frame[9] = (snake.apple_location[1] - head_y) / height
+        frame[10:14] = (head_y / height, (width - 1 - head_x) / width, (height - 1 - head_y) / height, head_x / width)
+        frame[14] = (len(snake.body_locations) + 1) / (width * height)
+        return None
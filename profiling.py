@@ -0,0 +1,99 @@
+"""Frame-time instrumentation for the game loop.
+
+`FrameProfiler` times phases of the loop by wrapping methods in place (`instrument`), keeps the most recent
+`window_size` samples of every phase in a ring buffer for rolling percentiles, and exports a summary as
+JSON or CSV. Uninstrumenting removes the wrappers again, so a disabled profiler costs nothing.
+"""
+import csv
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+
+class FrameProfiler():
+
+    def __init__(self, window_size=600) -> None:
+        self.window_size = window_size
+        self.samples = {}  # phase -> ring buffer of the latest durations, in ms
+        self.sample_counts = {}  # phase -> total number of samples recorded
+        self.counters = {}
+        self._instrumented = []  # (owner, method name) pairs that currently have a timing wrapper
+        return None
+
+    @property
+    def enabled(self) -> bool:
+        return len(self._instrumented) > 0
+
+    def instrument(self, owner, method_name, phase):
+        """Replaces `owner.method_name` (on this instance only) with a wrapper that times every call as `phase`"""
+        method = getattr(owner, method_name)
+        perf_counter = time.perf_counter
+
+        def timed_method(*args, **kwargs):
+            start_time = perf_counter()
+            result = method(*args, **kwargs)
+            self.record(phase, perf_counter() - start_time)
+            return result
+
+        setattr(owner, method_name, timed_method)
+        self._instrumented.append((owner, method_name))
+        return None
+
+    def uninstrument(self):
+        """Removes every timing wrapper, restoring the original methods"""
+        for owner, method_name in reversed(self._instrumented):
+            delattr(owner, method_name)
+        self._instrumented = []
+        return None
+
+    def record(self, phase, seconds):
+        if phase not in self.samples:
+            self.samples[phase] = np.zeros(self.window_size)
+            self.sample_counts[phase] = 0
+        self.samples[phase][self.sample_counts[phase] % self.window_size] = seconds * 1000
+        self.sample_counts[phase] += 1
+        return None
+
+    def reset(self):
+        """Forgets every sample and counter (the methods stay instrumented)"""
+        self.samples = {}
+        self.sample_counts = {}
+        self.counters = {}
+        return None
+
+    def set_counters(self, **counters):
+        self.counters.update(counters)
+        return None
+
+    def get_phase_summary(self, phase) -> dict:
+        """Count, mean, max and rolling percentiles (in ms) over the last `window_size` samples of `phase`"""
+        window = self.samples[phase][:min(self.sample_counts[phase], self.window_size)]
+        summary = dict(count=self.sample_counts[phase], mean_ms=float(window.mean()), max_ms=float(window.max()))
+        for percentile, value in zip(PERCENTILES, np.percentile(window, PERCENTILES)):
+            summary[f'p{percentile}_ms'] = float(value)
+        return summary
+
+    def get_summary(self) -> dict:
+        return dict(phases={phase: self.get_phase_summary(phase) for phase in self.samples},
+                    counters=dict(self.counters))
+
+    def export(self, path):
+        """Writes the summary to `path`, as CSV (`metric,value` rows) if it ends in `.csv` and as JSON otherwise"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        summary = self.get_summary()
+        if path.suffix == '.csv':
+            with open(path, 'w', newline='') as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerow(['metric', 'value'])
+                for phase, phase_summary in summary['phases'].items():
+                    writer.writerows([f'{phase}.{stat}', value] for stat, value in phase_summary.items())
+                writer.writerows([f'counters.{name}', value] for name, value in summary['counters'].items())
+        else:
+            with open(path, 'w') as json_file:
+                json.dump(summary, json_file, indent=2)
+        return None
@@ -1,25 +1,76 @@
+from array import array
+from collections import deque
 from datetime import datetime
 from pathlib import Path
 import json
+import logging
+import os
+import tempfile
+import time
 from typing import Union
 
-import matplotlib.pyplot as plt
 import pygame
 import numpy as np
-from skimage.transform import resize, rescale
+
+from autopilot import MAX_IDLE_LAPS
+from game_history import GameHistory, get_outcome, summarize_frame_times
+from profiling import FrameProfiler
+from replay import ReplayRecorder
+from snake_state import ACTIONS, ACTION_TO_ID, NO_ACTION, SnakeState
+from video_export import VideoExporter
 
 # todo list:
 #TODO: Add comments, like everywhere :p  (future me will thank current me : )
 #TODO: unify all event/keypress checking into one function and just return a string (e.g., convert_event_to_action(keypress) --> 'up' or 'pause')
 
 HEADER_HEIGHT_OFFSET = 50  # 50px
+MAX_CATCH_UP_TICKS = 5  # after a long frame (or a pause) the simulation runs at most this many ticks at once
+HUD_REFRESH_MS = 250  # how often the performance HUD in the header is redrawn
+HUD_KEYS = [pygame.K_F3, pygame.K_BACKQUOTE]
+SPRITE_SHEET_GRID = (4, 4)  # the sprite sheet is 4 rows of 4 sprites
+SPRITE_CACHE_DIR_NAME = '.sprite_cache'  # sliced sprite sheets are cached in this folder next to the sheet
+MIN_SPRITE_SIZE = 8  # sprites are never scaled below this (in px), bigger boards scroll instead
+CAMERA_MARGIN = 4  # cells kept between the head and the edge of the view when the board doesn't fit on screen
+MINIMAP_MAX_SIZE = 128  # the minimap is at most this big (in px), each pixel covering a square of cells
+MINIMAP_COLORS = {'empty': (20, 20, 20), 'body': (0, 160, 0), 'head': (255, 255, 255), 'apple': (255, 0, 0),
+                  'view': (255, 255, 0)}
+MINIMAP_KEYS = [pygame.K_m, pygame.K_TAB]
+HISTORY_FILE_NAME = 'history.sqlite3'  # every finished game is saved to this database in `record_dir`
+FRAME_MS_HISTOGRAM_SIZE = 256  # frame times are counted per ms for the game history, longer frames go in the last bin
+_loaded_sprite_sheets = {}  # (sheet path, sheet mtime, sprite size) -> sliced sprites, shared within the process
+
+logger = logging.getLogger('snake')
+MOVE_DELTAS = {'up': (0, -1), 'down': (0, 1), 'left': (-1, 0), 'right': (1, 0)}
+OPPOSITE_MOVES = {'up': 'down', 'down': 'up', 'left': 'right', 'right': 'left'}
+# the sprite sheet is transposed, so a body part that the snake left by moving `up` uses the `*-left` sprite, etc.
+BODY_SPRITE_DIRECTIONS = {'up': 'left', 'right': 'up', 'down': 'right', 'left': 'down'}
+# Order of the sprites in `Snake.sprite_atlas`, id 0 is an empty (black) cell
+SPRITE_KEYS = ('empty', 'head-up', 'head-right', 'head-down', 'head-left', 'body-up', 'body-down', 'body-left',
+               'body-right', 'tail-up', 'tail-right', 'tail-down', 'tail-left', 'apple')
+SPRITE_KEY_IDS = {sprite_key: sprite_id for sprite_id, sprite_key in enumerate(SPRITE_KEYS)}
+# sprite ids of body/tail parts indexed by `scaled_location_distance + 2`, where the scaled distance of a part is
+# `(part - next part towards the head) . (1, 2)` (see `Snake.get_sprite_ids`)
+BODY_SPRITE_IDS = np.array([SPRITE_KEY_IDS[key] if key is not None else 0
+                            for key in ['body-right', 'body-up', None, 'body-down', 'body-left']])
+TAIL_SPRITE_IDS = np.array([SPRITE_KEY_IDS[key] if key is not None else 0
+                            for key in ['tail-right', 'tail-up', None, 'tail-down', 'tail-left']])
 
 class Game():
     
-    def __init__(self, snake, screen, frames_per_second=4, record_dir=None) -> None:
+    def __init__(self, snake, screen, frames_per_second=4, record_dir=None, uncapped_clock=False,
+                 render_fps=60, interpolate_head=False, input_queue_size=3, profile_path=None, autopilot=None,
+                 show_minimap=None, video_format=None) -> None:
         self.screen = screen
-        self.fps = frames_per_second
+        self.fps = frames_per_second  # simulation ticks per second (i.e. the snake's speed)
+        self.render_fps = render_fps  # frames drawn per second, independent of the simulation speed
+        self.interpolate_head = interpolate_head  # slide the head between cells instead of jumping once per tick
+        self.uncapped_clock = uncapped_clock  # if True, run as fast as possible instead of at `fps` (for benchmarks)
         self.clock = pygame.time.Clock()
+        # key presses wait here (as move strings) and are used up one per tick, extra presses are dropped
+        self.input_queue = deque()
+        self.input_queue_size = input_queue_size
+        # a callable `autopilot(snake) -> move` (see `autopilot.py`) that steers whenever no key was pressed
+        self.autopilot = autopilot
         self.snake = snake
         if record_dir is None:
             self.record_dir = None
@@ -27,40 +78,254 @@ class Game():
             self.record_dir = Path(record_dir)
             if not self.record_dir.exists():
                 self.record_dir.mkdir(parents=True)
+        self.recording_name = f'{datetime.now():%Y%m%d-%H%M%S}-{snake.random_seed}'
+        self.recorder = self.make_recorder()
+        # with a `video_format` (see `video_export.FORMATS`), every drawn frame is also encoded to a video
+        self.video_format = video_format
+        self.video_exporter = None
+        self.history = None if self.record_dir is None else GameHistory(self.record_dir/HISTORY_FILE_NAME)
         self.high_score = self.get_current_highscore()
         self.score = 0
+        self.round_start_time = None
+        self.frame_ms_counts = [0] * FRAME_MS_HISTOGRAM_SIZE  # frames of this round by how many ms they took
+        screen_size = self.screen.get_size()
+        self.assets = SpriteCache(snake.sprites, screen_size)
+        # boards that don't fit on screen scroll with the head, with a minimap (toggled with M/Tab, shown by
+        # default when `show_minimap` is None) of the whole board
+        self.board_renderer = BoardRenderer(snake, self.assets, (screen_size[0], screen_size[1] - HEADER_HEIGHT_OFFSET),
+                                            show_minimap=show_minimap)
+        self.rendered_scores = None  # (score, high score) currently shown in the header
+
+        # Instrumentation: the profiler only wraps (and so only slows down) anything while the HUD is shown
+        # or a `profile_path` to export to at the end of every round was given
+        self.profiler = FrameProfiler()
+        self.profile_path = None if profile_path is None else Path(profile_path)
+        self.show_hud = False
+        self.next_hud_refresh_ms = 0
+        self.n_steps = 0
+        self.n_dropped_inputs = 0
+        if self.profile_path is not None:
+            self.enable_profiling()
+        self.video_exporter = self.make_video_exporter()
         return None
 
-    def run_game(self):
-        # initially display the board
+    def run_session(self):
+        """Plays rounds until the player quits. A restart reuses the window, the caches and this Game, and resets
+        the snake in place, so the session doesn't grow the stack or reload anything however many rounds it lasts."""
+        while self.run_game() == 'restart':
+            self.restart_game()
+        self.exit_game()
+        return None
+
+    def run_game(self) -> str:
+        """Plays one round, returning 'restart' if the player wants another one or 'quit'"""
+        # The simulation advances in fixed ticks of 1/fps seconds, while frames are drawn at `render_fps`.
+        # `tick_progress` is how far (in ticks) the time since the last simulated tick has got.
         self.is_running = True
-        while self.is_running and self.snake.is_alive:
+        self.is_stalled = False  # the autopilot went on too long without eating, see `check_for_stall`
+        self.n_idle_ticks = 0
+        self.idle_length = len(self.snake.body_locations)
+        self.input_queue.clear()
+        self.round_start_time = time.monotonic()
+        self.frame_ms_counts[:] = [0] * FRAME_MS_HISTOGRAM_SIZE
+        self.round_start_high_score = self.high_score
+        # the profile and its counters are per round
+        self.profiler.reset()
+        self.n_steps = 0
+        self.n_dropped_inputs = 0
+        self.board_renderer.reset_counters()
+        tick_progress = 0.0
+        self.clock.tick()
+        while self.is_running and self.snake.is_alive and not self.snake.has_won:
+            # initially display the board
             self.calculate_score()
-            self.display_board()
-            did_move_happen = False
-            self.clock.tick(self.fps)
-            for event in pygame.event.get():
-                if not self.check_for_special_event(event) and event.type == pygame.KEYDOWN:
-                    did_move_happen = self.snake.update_from_new_move(event.key)
-                    if did_move_happen:
-                        # break  # this way only one move happens per click tick
-                        pass
-            if not did_move_happen:
-                # no move was made, so input last event (i.e. keep the snake going in its current direction)
-                self.snake.update_from_new_move(self.snake.previous_move)
+            self.display_board(head_progress=tick_progress if self.interpolate_head else None)
+            if self.uncapped_clock:
+                frame_ms = self.clock.tick()
+                tick_progress = 1.0  # exactly one tick per frame, as fast as possible
+            else:
+                frame_ms = self.clock.tick(self.render_fps)
+                tick_progress = min(tick_progress + frame_ms / 1000 * self.fps, MAX_CATCH_UP_TICKS)
+            self.frame_ms_counts[min(frame_ms, FRAME_MS_HISTOGRAM_SIZE - 1)] += 1
+            if self.profiler.enabled:
+                self.profiler.record('frame', frame_ms / 1000)
+            self.handle_events()
+            while tick_progress >= 1 and self.is_running and self.snake.is_alive and not self.snake.has_won:
+                self.advance_tick()
+                if self.autopilot is not None:
+                    self.check_for_stall()
+                tick_progress -= 1
 
         # game is over, off with the snake and close the game
-        self.save_highscore()
-        print(f"Game over!")
-        if not self.snake.is_alive:
+        if self.recorder is not None:
+            self.recorder.close()
+        self.close_video_exporter()
+        self.calculate_score()  # the last move wasn't counted yet
+        if self.profile_path is not None:
+            self.export_profile(self.get_round_profile_path())
+        if self.high_score != self.round_start_high_score:
+            logger.info(f'New high score! High score is now: {self.high_score}')
+        self.save_game_record()
+        logger.info("Game over!")
+        if self.snake.has_won:
+            self.make_win_animation()
+            return self.wait_for_user_to_quit()
+        elif not self.snake.is_alive:
             self.make_death_animation()
-            self.wait_for_user_to_quit()
+            return self.wait_for_user_to_quit()
+        elif self.is_stalled:
+            self._print_str_to_screen("STALLED!", color=(255, 0, 0))
+            return self.wait_for_user_to_quit()
         else:
             # the snake did not die, but the game was manually exited quit
-            self.exit_game()
-        return None
+            return 'quit'
     
-    def wait_for_user_to_quit(self):
+    def handle_events(self):
+        for event in pygame.event.get():
+            if not self.check_for_special_event(event) and event.type == pygame.KEYDOWN:
+                self.queue_move(event.key)
+        return None
+
+    def queue_move(self, keypress_value) -> bool:
+        """Queues a directional key press for a later tick. Returns False if it isn't a move or the queue is full"""
+        move = self.snake._convert_keypress_to_str(keypress_value)
+        if move is None:
+            return False
+        if len(self.input_queue) >= self.input_queue_size:
+            self.n_dropped_inputs += 1
+            return False
+        self.input_queue.append(move)
+        return True
+
+    def advance_tick(self):
+        """One simulation tick: uses up queued moves until one is accepted (so a rejected reversal doesn't
+        swallow the press after it), or lets the autopilot steer, or keeps the snake going in its current direction"""
+        while self.input_queue:
+            if self.move_snake(self.input_queue.popleft()):
+                return None
+        if self.autopilot is not None and self.move_snake(self.autopilot(self.snake)):
+            return None
+        # no move was made, so input last event (i.e. keep the snake going in its current direction)
+        self.move_snake(self.snake.previous_move)
+        return None
+
+    def check_for_stall(self):
+        """Ends the round once the snake has gone `MAX_IDLE_LAPS` board sizes' worth of ticks without eating, like
+        `autopilot.play_game` does (a pathfinding autopilot can end up chasing its tail forever)"""
+        length = len(self.snake.body_locations)
+        if length != self.idle_length:
+            self.idle_length, self.n_idle_ticks = length, 0
+            return None
+        self.n_idle_ticks += 1
+        if self.n_idle_ticks >= MAX_IDLE_LAPS * self.snake.occupancy.size:
+            logger.info(f'The autopilot made no progress in {self.n_idle_ticks} ticks, ending the game')
+            self.is_stalled = True
+            self.is_running = False
+        return None
+
+    def fast_forward(self, moves) -> int:
+        """Plays a scripted sequence of `moves` through the normal score/display/move cycle as fast as possible,
+        without waiting on the clock or reading any events. Stops early if the game ends.
+        Returns the number of ticks that were played."""
+        moves = iter(moves)
+        n_ticks = 0
+        while self.snake.is_alive and not self.snake.has_won:
+            move = next(moves, StopIteration)
+            if move is StopIteration:
+                break
+            self.calculate_score()
+            self.display_board()
+            self.move_snake(move)
+            n_ticks += 1
+        return n_ticks
+
+    def move_snake(self, move) -> bool:
+        """Moves the snake (see `Snake.update_from_new_move`) and records the move if it was accepted"""
+        did_move_happen = self.snake.update_from_new_move(move)
+        if did_move_happen:
+            self.n_steps += 1
+            if self.recorder is not None:
+                self.recorder.record(self.snake)
+        return did_move_happen
+
+    def enable_profiling(self):
+        """Times each phase of the game loop with `self.profiler` (see `profiling.py`)"""
+        if self.profiler.enabled:
+            return None
+        self.profiler.instrument(self, 'handle_events', 'events')
+        self.profiler.instrument(self, 'calculate_score', 'score')
+        self.profiler.instrument(self, 'display_board', 'render')
+        self.profiler.instrument(self.snake, 'update_from_new_move', 'step')
+        return None
+
+    def disable_profiling(self):
+        self.profiler.uninstrument()
+        return None
+
+    def toggle_hud(self):
+        """Shows/hides the performance HUD in the header (profiling runs while it is shown)"""
+        self.show_hud = not self.show_hud
+        if self.show_hud:
+            self.enable_profiling()
+        elif self.profile_path is None:
+            self.disable_profiling()
+        self.rendered_scores = None  # forces the header to be redrawn
+        return None
+
+    def update_profiler_counters(self):
+        self.profiler.set_counters(steps=self.n_steps, dropped_inputs=self.n_dropped_inputs,
+                                   redrawn_cells=self.board_renderer.n_redrawn_cells,
+                                   full_redraws=self.board_renderer.n_full_redraws,
+                                   scrolls=self.board_renderer.n_scrolls)
+        return None
+
+    def get_round_profile_path(self) -> Path:
+        """Where this round's profile goes: `profile_path` with the recording name of the round added to it,
+        e.g. `profile-20240101-120000-42.json`"""
+        return self.profile_path.with_name(f'{self.profile_path.stem}-{self.recording_name}{self.profile_path.suffix}')
+
+    def export_profile(self, path):
+        """Writes the profiler summary to `path` (JSON, or CSV if the path ends in `.csv`)"""
+        if not self.profiler.samples:
+            return None
+        self.update_profiler_counters()
+        self.profiler.export(path)
+        logger.info(f'Saved frame time profile to {path}')
+        return None
+
+    def make_recorder(self):
+        """Every game is recorded to `record_dir/replays` (if there is a `record_dir`), see `replay.py`"""
+        if self.record_dir is None:
+            return None
+        replay_name = f'{self.recording_name}.snakereplay'
+        return ReplayRecorder(self.record_dir/'replays'/replay_name, self.snake.random_seed, self.snake.board.shape[1:])
+
+    def make_video_exporter(self):
+        """With a `video_format`, the screen is recorded to `record_dir/videos` (if there is a `record_dir`).
+        Frames are encoded on a background thread, and dropped rather than slowing the game down."""
+        if self.record_dir is None or self.video_format is None:
+            return None
+        video_name = self.recording_name if self.video_format == 'png' else f'{self.recording_name}.{self.video_format}'
+        try:
+            return VideoExporter(self.record_dir/'videos'/video_name, self.screen.get_size(), fps=self.render_fps,
+                                 video_format=self.video_format, overflow='drop')
+        except OSError as error:  # e.g. there is no ffmpeg to encode mp4/gif with
+            logger.error(f'Not recording video: {error}')
+            return None
+
+    def close_video_exporter(self):
+        if self.video_exporter is None:
+            return None
+        try:
+            self.video_exporter.close()
+            logger.info(f'Saved video to {self.video_exporter.output_path}')
+        except RuntimeError as error:
+            logger.error(f'{error}: {error.__cause__}')
+        self.video_exporter = None
+        return None
+
+    def wait_for_user_to_quit(self) -> str:
+        """Waits for Esc (or closing the window) or Enter, and returns 'quit' or 'restart'"""
         location = ((self.screen.get_size()[0] // 7), int(self.screen.get_size()[1]/1.25))
         font_size = self.screen.get_size()[0]//20
         self._print_str_to_screen("Press Esc key to quit or Enter to restart", location=location, font_size=font_size, color=(255, 0, 0))
@@ -74,13 +339,9 @@ class Game():
                         action = 'restart'
                 elif event.type == pygame.QUIT:
                     action = 'quit'
-
-                if action == 'quit':
-                    print(f'Action happened! {action}')
-                    self.exit_game()
-                elif action == 'restart':
-                    print(f'Action happened! {action}')
-                    self.restart_game()
+            self.clock.tick(30)  # no need to spin while waiting
+        logger.debug(f'Action happened! {action}')
+        return action
 
     def check_for_special_event(self, event) -> bool:
         """ checks if the event is a non-key directional command (i.e. quit, pause, speed up/down, etc)
@@ -89,6 +350,12 @@ class Game():
             self.is_running = False
             return True
         elif event.type == pygame.KEYDOWN:
+            if event.key in HUD_KEYS:
+                self.toggle_hud()
+                return True
+            if event.key in MINIMAP_KEYS:
+                self.board_renderer.toggle_minimap()
+                return True
             # check for pausing:
             if event.key in [pygame.K_p, pygame.K_SLASH, pygame.K_r, pygame.K_SPACE]:
                 self.pause_game()
@@ -105,34 +372,88 @@ class Game():
                 return True
         return False
 
-    def display_board(self):
-        self.screen.fill((40, 40, 40)) # first reset the screen
-        screen_size = list(self.screen.get_size())
-        # subtracting the header height from the game screen to get the effective game screen size
-        game_screen_size = [screen_size[0], screen_size[1] - HEADER_HEIGHT_OFFSET]  
+    def display_board(self, head_progress=None):
+        """Draws the changed parts of the screen. `head_progress` (0 to 1) slides the head that far from its
+        previous cell towards its current one, see `BoardRenderer.draw`"""
+        if self.assets.validate(self.screen.get_size()):
+            # the window was resized, so the cached Surfaces were dropped and everything has to be redrawn
+            self.board_renderer.invalidate()
+        full_redraw = self.board_renderer.needs_full_redraw
+        if full_redraw:
+            self.screen.fill((40, 40, 40)) # first reset the screen
 
-        # B to screen 
-        
+        # Render board (only the cells that changed since the last frame, unless everything needs redrawing)
+        dirty_rects = self.board_renderer.draw(self.screen, head_progress=head_progress)
+
+        # Render the score header, which only changes when the snake grows (or every so often with the HUD on)
+        if full_redraw or self.rendered_scores != (self.score, self.high_score):
+            dirty_rects.append(self.display_header())
+        elif self.show_hud and pygame.time.get_ticks() >= self.next_hud_refresh_ms:
+            dirty_rects.append(self.display_header())
+
+        if full_redraw:
+            pygame.display.update()
+        else:
+            pygame.display.update(dirty_rects)
+        if self.video_exporter is not None:
+            try:
+                self.video_exporter.add_frame(self.screen)  # just a copy, the encoding happens on another thread
+            except RuntimeError:
+                self.close_video_exporter()  # the encoder failed, the game goes on without video
+        return None
 
-        # Render board
-        board_to_display = self.snake.prepare_board_for_displaying(game_screen_size)
-        pygame_board = pygame.surfarray.make_surface(board_to_display)
-        self.screen.blit(pygame_board, (0,HEADER_HEIGHT_OFFSET))
+    def display_header(self) -> pygame.Rect:
+        """Re-renders the score and high score, returning the header rect that changed"""
+        screen_size = list(self.screen.get_size())
+        header_rect = self.screen.fill((40, 40, 40), pygame.Rect(0, 0, screen_size[0], HEADER_HEIGHT_OFFSET))
+        if self.show_hud:
+            self.display_hud()
+            self.rendered_scores = (self.score, self.high_score)
+            return header_rect
 
-        # Render score
-        font = pygame.font.SysFont("Arial", size=int(HEADER_HEIGHT_OFFSET*0.75))
-        score_text = font.render(f"Score: {self.score}", True, (255, 255, 255))
+        # Render score (from cached glyphs)
+        font_size = int(HEADER_HEIGHT_OFFSET*0.75)
+        score_text = f"Score: {self.score}"
         score_location = (int(screen_size[0]*0.01), int(HEADER_HEIGHT_OFFSET*0.125))
-        self.screen.blit((score_text), score_location)
+        header_blits = self.assets.get_text_blits(score_text, font_size, (255, 255, 255), score_location)
 
         # Render high score
         if self.high_score is not None:
-            high_score_text = font.render(f"High Score: {self.high_score}", True, (255, 255, 255))
-            score_location = (max(score_text.get_width(), screen_size[0]-high_score_text.get_width()),
+            high_score_text = f"High Score: {self.high_score}"
+            high_score_width = self.assets.get_text_width(high_score_text, font_size)
+            score_location = (max(self.assets.get_text_width(score_text, font_size), screen_size[0]-high_score_width),
                               int(HEADER_HEIGHT_OFFSET*0.125))
-            self.screen.blit((high_score_text), score_location)
+            header_blits += self.assets.get_text_blits(high_score_text, font_size, (255, 255, 255), score_location)
+        self.screen.blits(header_blits, doreturn=False)
 
-        pygame.display.update()
+        self.rendered_scores = (self.score, self.high_score)
+        return header_rect
+
+    def display_hud(self):
+        """Draws the performance overlay (rolling p50/p95/p99 per phase and the counters) over the header"""
+        self.update_profiler_counters()
+        summary = self.profiler.get_summary()
+
+        def format_phase(phase):
+            if phase not in summary['phases']:
+                return f'{phase} -'
+            phase_summary = summary['phases'][phase]
+            return f"{phase} {phase_summary['p50_ms']:.2f}/{phase_summary['p95_ms']:.2f}/{phase_summary['p99_ms']:.2f}"
+
+        counters = summary['counters']
+        hud_lines = [
+            f"score {self.score} (best {self.high_score}) | steps {counters['steps']} | "
+            f"dropped {counters['dropped_inputs']} | redrawn {counters['redrawn_cells']}",
+            f"{format_phase('frame')}  {format_phase('render')}  {format_phase('step')}",
+            f"{format_phase('events')}  {format_phase('score')}  ms p50/p95/p99",
+        ]
+        font_size = HEADER_HEIGHT_OFFSET // 4
+        hud_blits = []
+        for line_idx, hud_line in enumerate(hud_lines):
+            location = (4, 2 + line_idx * (HEADER_HEIGHT_OFFSET // 3))
+            hud_blits += self.assets.get_text_blits(hud_line, font_size, (255, 255, 0), location)
+        self.screen.blits(hud_blits, doreturn=False)
+        self.next_hud_refresh_ms = pygame.time.get_ticks() + HUD_REFRESH_MS
         return None
 
     def pause_game(self):
@@ -156,6 +477,7 @@ class Game():
 
                     elif event.key in [pygame.K_r, pygame.K_SLASH, pygame.K_SPACE]:  # K_SLASH toggles pause
                         # remove the pause text
+                        self.board_renderer.invalidate()
                         self.display_board()
                         return None
                     
@@ -165,71 +487,437 @@ class Game():
             location = ((self.screen.get_size()[0] // 7), self.screen.get_size()[1]//2)
         if font_size == 'auto':    
             font_size = self.screen.get_size()[0]//8
-        font = pygame.font.SysFont("Arial", size=font_size)
-        text = font.render(text, True, color)
+        text = self.assets.get_font(font_size).render(text, True, color)
         self.screen.blit((text), location)
         pygame.display.update()
         return None
 
     def get_current_highscore(self) -> int:
-        if self.record_dir is None:
+        """The best score in the game history on this board size, or the high score of the old `saves.json` (from
+        before the history was kept, which is only read now) if that one is higher, so the old record still stands"""
+        if self.history is None:
             return None
-        elif not (self.record_dir/'saves.json').exists():
-            return None
-        else:
-            # load saves            
+        high_score = self.history.get_high_score(self.snake.board.shape[1:])
+        if (self.record_dir/'saves.json').exists():
             with open(self.record_dir/'saves.json', 'r') as save_file:
-                high_score = json.load(save_file)['high_score']
-            return high_score
+                legacy_high_score = json.load(save_file)['high_score']
+            if high_score is None or (legacy_high_score is not None and legacy_high_score > high_score):
+                high_score = legacy_high_score
+        return high_score
 
-    def save_highscore(self):
-        if self.record_dir is None:
+    def save_game_record(self) -> bool:
+        """Adds the round that just ended to the game history, which writes it to disk off the game loop"""
+        if self.history is None:
             return False
-        else:
-            # overwrite save file
-            with open(self.record_dir/'saves.json', 'w') as save_file:
-                json.dump(dict(high_score=self.high_score), save_file)
-            return True
+        board_width, board_height = self.snake.board.shape[1:]
+        self.history.add(dict(finished_at=time.time(),
+                              random_seed=self.snake.random_seed,
+                              board_width=board_width,
+                              board_height=board_height,
+                              score=self.score,
+                              steps=self.snake.n_moves,
+                              duration_s=time.monotonic() - self.round_start_time,
+                              outcome=get_outcome(self.snake, is_stalled=self.is_stalled),
+                              **summarize_frame_times(self.frame_ms_counts)))
+        return True
 
     def calculate_score(self):
         self.score = len(self.snake.body_locations)+1
         # Checking against high score
         if self.high_score is None or self.score > self.high_score:
-            print(f'New high score! High score is now: {self.score}')
-            self.high_score = self.score
+            self.high_score = self.score  # logged when the round ends, not on every apple
         return None
 
     def make_death_animation(self):
         self._print_str_to_screen("DEAD!", color=(255, 0, 0))
         return None
+
+    def make_win_animation(self):
+        self._print_str_to_screen("YOU WIN!", color=(0, 255, 0))
+        return None
         
     def exit_game(self):
-        print('DEAD!')
+        logger.info('DEAD!')
         if self.score is not None:
-            print(f'Final score: {self.score}')
+            logger.info(f'Final score: {self.score}')
         # raise RuntimeError('the snake has stopped running (because it died)')
+        if self.history is not None:
+            self.history.close()  # writes out the games that are still queued
         pygame.quit()
 
-    def restart_game(self):
-        print('Starting new game!')
-        start_game()  # then start a new game
+    def restart_game(self, random_seed=None):
+        """Sets up a new round in place: the snake is reset, and the recordings start over for the new game"""
+        logger.info('Starting new game!')
+        self.snake.reset(random_seed)
+        if self.autopilot is not None and hasattr(self.autopilot, 'reset'):
+            self.autopilot.reset()
+        self.recording_name = f'{datetime.now():%Y%m%d-%H%M%S}-{self.snake.random_seed}'
+        self.recorder = self.make_recorder()
+        self.video_exporter = self.make_video_exporter()
+        self.score = 0
+        self.input_queue.clear()
+        self.board_renderer.invalidate()
+        self.rendered_scores = None
+        return None
+
+class SpriteCache():
+    """Display-ready pygame Surfaces for the sprites (one per `'{type}-{direction}'` key), the fonts
+    and the text glyphs, so nothing is converted or looked up with `SysFont` while the game runs.
+
+    Everything is built lazily on first use and dropped whenever the sprite size or the window size changes.
+    """
+
+    def __init__(self, sprites: dict, window_size, font_name="Arial") -> None:
+        self.font_name = font_name
+        self.sprites = sprites
+        self.sprite_size = tuple(sprites['apple'].shape[:2])
+        self.window_size = tuple(window_size)
+        self.clear()
+        return None
+
+    def clear(self):
+        self.sprite_surfaces = {}  # sprite key -> Surface
+        self.background_tiles = {}  # color -> Surface of one empty cell
+        self.fonts = {}  # font size -> Font
+        self.glyphs = {}  # (character, font size, color) -> Surface
+        return None
+
+    def validate(self, window_size) -> bool:
+        """Drops the cached entries if the window size changed. Returns True if they were dropped"""
+        if tuple(window_size) == self.window_size:
+            return False
+        self.window_size = tuple(window_size)
+        self.clear()
+        return True
+
+    def set_sprites(self, sprites: dict):
+        """Swaps in a new sprite set, dropping the cached entries if the sprite size changed"""
+        self.sprites = sprites
+        if tuple(sprites['apple'].shape[:2]) != self.sprite_size:
+            self.sprite_size = tuple(sprites['apple'].shape[:2])
+            self.clear()
+        else:
+            self.sprite_surfaces = {}
+        return None
+
+    def get_sprite(self, sprite_key) -> pygame.Surface:
+        if sprite_key not in self.sprite_surfaces:
+            self.sprite_surfaces[sprite_key] = self._to_display_format(
+                pygame.surfarray.make_surface(self.sprites[sprite_key]))
+        return self.sprite_surfaces[sprite_key]
+
+    def get_background_tile(self, color) -> pygame.Surface:
+        if color not in self.background_tiles:
+            tile = pygame.Surface(self.sprite_size)
+            tile.fill(color)
+            self.background_tiles[color] = self._to_display_format(tile)
+        return self.background_tiles[color]
+
+    def get_font(self, font_size) -> pygame.font.Font:
+        if font_size not in self.fonts:
+            self.fonts[font_size] = pygame.font.SysFont(self.font_name, size=font_size)
+        return self.fonts[font_size]
+
+    def get_glyph(self, character, font_size, color) -> pygame.Surface:
+        glyph_key = (character, font_size, color)
+        if glyph_key not in self.glyphs:
+            self.glyphs[glyph_key] = self.get_font(font_size).render(character, True, color)
+        return self.glyphs[glyph_key]
+
+    def get_text_width(self, text, font_size) -> int:
+        return sum(self.get_glyph(character, font_size, (255, 255, 255)).get_width() for character in text)
+
+    def get_text_blits(self, text, font_size, color, location) -> list:
+        """Returns the `(glyph, position)` pairs that draw `text` at `location`, ready for `Surface.blits`"""
+        blit_sequence = []
+        x, y = location
+        for character in text:
+            glyph = self.get_glyph(character, font_size, color)
+            blit_sequence.append((glyph, (x, y)))
+            x += glyph.get_width()
+        return blit_sequence
+
+    @staticmethod
+    def _to_display_format(surface) -> pygame.Surface:
+        # converting is only possible (and only useful) once a display mode is set
+        return surface.convert() if pygame.display.get_surface() is not None else surface
+
+class BoardRenderer():
+    """Retained-mode renderer for the board part of the screen.
+
+    The board is kept on a persistent Surface, and each frame only the cells listed in
+    `snake.changed_locations` (normally the head, neck, tail, vacated cell and apple) are redrawn.
+    `draw` returns the screen rects that changed so they can be passed to `pygame.display.update`.
+
+    Boards that don't fit in the board area are seen through a camera: only the `viewport_size` cells from
+    `camera` (the top-left cell in view) on are drawn, and the camera scrolls to keep the head `camera_margin`
+    cells away from the edges. A scroll moves the drawn pixels over with `Surface.scroll` and only draws the
+    cells that came into view, so the cost of a frame depends on the size of the view, not of the board.
+    """
+
+    def __init__(self, snake, assets, board_area_size, top_left=(0, HEADER_HEIGHT_OFFSET), background_color=(0, 0, 0),
+                 camera_margin=CAMERA_MARGIN, show_minimap=None):
+        self.snake = snake
+        self.assets = assets
+        self.top_left = top_left
+        self.background_color = background_color
+        self.surface = pygame.Surface(board_area_size)
+        self.camera_margin = camera_margin
+        self.update_viewport()
+        # by default the minimap is only shown if the board doesn't fit
+        self.show_minimap = self.viewport_size != tuple(snake.board.shape[1:]) if show_minimap is None else show_minimap
+        self.minimap = Minimap(snake)
+        self.needs_full_redraw = True
+        self.sliding_head_locations = ()  # the cells the sliding head was drawn over in the last frame
+        self.n_redrawn_cells = 0
+        self.n_full_redraws = 0
+        self.n_scrolls = 0
+
+    def reset_counters(self):
+        self.n_redrawn_cells = 0
+        self.n_full_redraws = 0
+        self.n_scrolls = 0
+        return None
+
+    def invalidate(self):
+        """Forces the next `draw` to repaint the whole board (e.g. after text was printed over it)"""
+        self.needs_full_redraw = True
+        return None
+
+    def toggle_minimap(self):
+        self.show_minimap = not self.show_minimap
+        self.invalidate()  # the board under the minimap has to be drawn again when it is hidden
+        return None
+
+    def update_viewport(self):
+        """Fits the view to the board area at the current sprite size, and centres the camera on the head"""
+        board_size = self.snake.board.shape[1:]
+        area_size = self.surface.get_size()
+        self.viewport_size = tuple(min(board_cells, area_pixels // sprite_pixels)
+                                   for board_cells, area_pixels, sprite_pixels in
+                                   zip(board_size, area_size, self.assets.sprite_size))
+        self.camera = tuple(min(max(head - view // 2, 0), board_cells - view)
+                            for head, view, board_cells in zip(self.snake.head_location, self.viewport_size, board_size))
+        return None
+
+    def follow_head(self) -> tuple:
+        """Moves the camera (as little as possible) to keep the head `camera_margin` cells inside the view.
+        Returns how many cells it moved along each axis."""
+        new_camera = []
+        for head, camera, view, board_cells in zip(self.snake.head_location, self.camera, self.viewport_size,
+                                                   self.snake.board.shape[1:]):
+            margin = min(self.camera_margin, (view - 1) // 2)
+            head = min(max(head, 0), board_cells - 1)  # a head that ran into a wall is just off the board
+            camera = min(max(camera, head - (view - 1 - margin)), head - margin)
+            new_camera.append(min(max(camera, 0), board_cells - view))
+        shift = (new_camera[0] - self.camera[0], new_camera[1] - self.camera[1])
+        self.camera = tuple(new_camera)
+        return shift
+
+    def is_in_view(self, location) -> bool:
+        return (0 <= location[0] - self.camera[0] < self.viewport_size[0]
+                and 0 <= location[1] - self.camera[1] < self.viewport_size[1])
+
+    def get_locations_in_view(self, x_range, y_range) -> list:
+        """The snake and apple cells in the given (board) ranges of the view, from the occupancy grid"""
+        xs, ys = np.nonzero(self.snake.occupancy[x_range[0]:x_range[1], y_range[0]:y_range[1]])
+        locations = list(zip((xs + x_range[0]).tolist(), (ys + y_range[0]).tolist()))
+        apple_x, apple_y = self.snake.apple_location
+        if x_range[0] <= apple_x < x_range[1] and y_range[0] <= apple_y < y_range[1]:
+            locations.append(self.snake.apple_location)
+        return locations
+
+    def _scroll(self, shift) -> list:
+        """Moves the drawn cells over by `shift` cells, and returns the cells that came into view"""
+        cell_width, cell_height = self.assets.sprite_size
+        self.surface.scroll(-shift[0] * cell_width, -shift[1] * cell_height)
+        (camera_x, camera_y), (view_width, view_height) = self.camera, self.viewport_size
+        exposed_ranges = []  # (x range, y range) of the columns and rows that came into view
+        if shift[0] != 0:
+            first_column = camera_x + view_width - shift[0] if shift[0] > 0 else camera_x
+            exposed_ranges.append(((first_column, first_column + abs(shift[0])), (camera_y, camera_y + view_height)))
+        if shift[1] != 0:
+            first_row = camera_y + view_height - shift[1] if shift[1] > 0 else camera_y
+            exposed_ranges.append(((camera_x, camera_x + view_width), (first_row, first_row + abs(shift[1]))))
+        locations = []
+        for x_range, y_range in exposed_ranges:
+            self.surface.fill(self.background_color, pygame.Rect(
+                (x_range[0] - camera_x) * cell_width, (y_range[0] - camera_y) * cell_height,
+                (x_range[1] - x_range[0]) * cell_width, (y_range[1] - y_range[0]) * cell_height))
+            locations += self.get_locations_in_view(x_range, y_range)
+        self.n_scrolls += 1
+        return locations
+
+    def draw(self, screen, head_progress=None) -> list:
+        """Redraws the changed cells. If `head_progress` (0 to 1) is given, the head is drawn that far along
+        the way from its previous cell to its current one, instead of sitting in its current cell."""
+        head_location = self.snake.head_location
+        sliding_from = self.snake.previous_head_location if head_progress is not None else None
+        # the last frame's sliding head may have been over cells that didn't change since, which are cleaned up here
+        self.snake.changed_locations.update(self.sliding_head_locations)
+        if sliding_from is not None:
+            # the sliding head overlaps both cells, so they are redrawn every frame
+            self.snake.changed_locations.update((sliding_from, head_location))
+        self.sliding_head_locations = (sliding_from, head_location) if sliding_from is not None else ()
+
+        if self.needs_full_redraw:
+            self.update_viewport()
+        shift = self.follow_head()
+        did_scroll = shift != (0, 0) and not self.needs_full_redraw
+        if did_scroll and (abs(shift[0]) >= self.viewport_size[0] or abs(shift[1]) >= self.viewport_size[1]):
+            # nothing that is on the surface stays in view
+            self.needs_full_redraw, did_scroll = True, False
+
+        (camera_x, camera_y), (view_width, view_height) = self.camera, self.viewport_size
+        if self.needs_full_redraw:
+            self.surface.fill(self.background_color)
+            locations = self.get_locations_in_view((camera_x, camera_x + view_width), (camera_y, camera_y + view_height))
+        else:
+            locations = [location for location in self.snake.changed_locations if self.is_in_view(location)]
+            if did_scroll:
+                locations += self._scroll(shift)
+
+        # batch all the cell updates into one `blits` call (empty cells get a background tile)
+        cell_width, cell_height = self.assets.sprite_size
+        background_tile = self.assets.get_background_tile(self.background_color)
+        cell_rects = [pygame.Rect((location[0] - camera_x)*cell_width, (location[1] - camera_y)*cell_height,
+                                  cell_width, cell_height)
+                      for location in locations]
+        sprite_keys = [self.snake.get_sprite_key(location) for location in locations]
+        if sliding_from is not None:
+            # the head is drawn separately below, its cell gets the background for now
+            sprite_keys = [None if location == head_location else sprite_key
+                           for location, sprite_key in zip(locations, sprite_keys)]
+        self.surface.blits([(self.assets.get_sprite(sprite_key) if sprite_key is not None else background_tile, cell_rect)
+                            for sprite_key, cell_rect in zip(sprite_keys, cell_rects)],
+                           doreturn=False)
+        if self.show_minimap:
+            self.minimap.update(self.snake.changed_locations, full_update=self.needs_full_redraw)
+        self.snake.changed_locations.clear()
+        self.n_redrawn_cells += len(cell_rects)
+
+        if sliding_from is not None:
+            head_x = sliding_from[0] + (head_location[0] - sliding_from[0]) * min(head_progress, 1) - camera_x
+            head_y = sliding_from[1] + (head_location[1] - sliding_from[1]) * min(head_progress, 1) - camera_y
+            self.surface.blit(self.assets.get_sprite(self.snake.get_sprite_key(head_location)),
+                              (round(head_x*cell_width), round(head_y*cell_height)))
+
+        if self.needs_full_redraw or did_scroll:
+            if self.needs_full_redraw:
+                self.needs_full_redraw = False
+                self.n_full_redraws += 1
+            dirty_rects = [screen.blit(self.surface, self.top_left)]
+        else:
+            dirty_rects = screen.blits([(self.surface, cell_rect.move(self.top_left), cell_rect) for cell_rect in cell_rects])
+        if self.show_minimap:
+            dirty_rects.append(self.minimap.draw(screen, self.top_left, self.surface.get_width(), self.camera,
+                                                 self.viewport_size))
+        return dirty_rects
+
+
+class Minimap():
+    """A downsampled overview of the whole board, drawn over the top-right corner of the board area.
+
+    Every minimap pixel covers a `block_size` square of cells. Only the blocks of the cells that changed since
+    the last frame are repainted (from `snake.changed_locations`, passed on by `BoardRenderer`), so keeping it
+    up to date costs the same no matter how big the board is.
+    """
+
+    def __init__(self, snake, max_size=MINIMAP_MAX_SIZE) -> None:
+        self.snake = snake
+        board_size = snake.board.shape[1:]
+        self.block_size = max(1, -(-max(board_size) // max_size))
+        self.size = tuple(-(-board_cells // self.block_size) for board_cells in board_size)
+        self.pixels = np.zeros((*self.size, 3), dtype=np.uint8)
+        self.surface = pygame.Surface(self.size)
+        self.head_block = None
+        return None
+
+    def update(self, changed_locations, full_update=False):
+        """Repaints the blocks of `changed_locations` (or all of them with `full_update`)"""
+        block_size = self.block_size
+        if full_update:
+            # any part of the snake in a block, with the occupancy grid padded up to whole blocks
+            padded = np.zeros((self.size[0] * block_size, self.size[1] * block_size), dtype=bool)
+            padded[:self.snake.occupancy.shape[0], :self.snake.occupancy.shape[1]] = self.snake.occupancy
+            blocks_occupied = padded.reshape(self.size[0], block_size, self.size[1], block_size).any(axis=(1, 3))
+            self.pixels[...] = MINIMAP_COLORS['empty']
+            self.pixels[blocks_occupied] = MINIMAP_COLORS['body']
+            blocks = set()
+        else:
+            blocks = {(location[0] // block_size, location[1] // block_size) for location in changed_locations
+                      if self.snake.is_on_board(location)}
+        if self.head_block is not None:
+            blocks.add(self.head_block)
+        for block in blocks:
+            self._paint_block(block)
+        head_location = self.snake.head_location
+        if self.snake.is_on_board(head_location):
+            self.head_block = (head_location[0] // block_size, head_location[1] // block_size)
+            self.pixels[self.head_block] = MINIMAP_COLORS['head']
+        apple_location = self.snake.apple_location
+        self.pixels[apple_location[0] // block_size, apple_location[1] // block_size] = MINIMAP_COLORS['apple']
+        pygame.surfarray.blit_array(self.surface, self.pixels)
+        return None
+
+    def _paint_block(self, block):
+        x, y = block[0] * self.block_size, block[1] * self.block_size
+        is_occupied = self.snake.occupancy[x:x + self.block_size, y:y + self.block_size].any()
+        self.pixels[block] = MINIMAP_COLORS['body' if is_occupied else 'empty']
         return None
 
+    def draw(self, screen, board_top_left, board_area_width, camera, viewport_size) -> pygame.Rect:
+        """Blits the minimap with the camera's view outlined, returning the screen rect it covers"""
+        minimap_rect = self.surface.get_rect(topright=(board_top_left[0] + board_area_width - 1, board_top_left[1] + 1))
+        screen.blit(self.surface, minimap_rect)
+        view_rect = pygame.Rect(minimap_rect.left + camera[0] // self.block_size, minimap_rect.top + camera[1] // self.block_size,
+                                -(-viewport_size[0] // self.block_size), -(-viewport_size[1] // self.block_size))
+        pygame.draw.rect(screen, MINIMAP_COLORS['view'], view_rect, width=1)
+        return minimap_rect
+
 class Snake():
     def __init__(self, board_size=(16, 16), random_seed=42, sprite_location='snake-sprites.png', sprite_size=(16,16)): 
-        self.rng = np.random.RandomState(random_seed)
         self.effective_board_size = board_size
         self.sprites = self.get_sprites(sprite_location, sprite_size)
+        self.sprite_atlas = self.make_sprite_atlas(self.sprites)
+        self._display_buffer = None
+        self.rng = np.random.RandomState()
         self.board = np.zeros([3, *board_size], dtype=np.uint8)
+        # True wherever the snake (head or body) is, so collisions are a single lookup instead of a list scan
+        self.occupancy = np.zeros(board_size, dtype=bool)
+        # Indexed set of the free cells (flattened as x*height + y), so apples can be sampled in O(1):
+        # `free_cells` holds the cells in no particular order and `free_cell_positions` maps a cell to its index
+        self.free_cells = []
+        self.free_cell_positions = []
+        self.reset(random_seed)
+
+    def reset(self, random_seed=None):
+        """Starts a new game on the same board, reusing the sprites and the arrays (None picks a new random seed)"""
+        if random_seed is None:
+            # pick the seed here (rather than letting RandomState do it) so the game can be recorded and replayed
+            random_seed = int(np.random.SeedSequence().entropy % 2**32)
+        self.random_seed = random_seed
+        self.rng.seed(random_seed)
+        board_size = self.board.shape[1:]
+        self.board.fill(0)
+        self.occupancy.fill(False)
+        self.free_cells[:] = range(board_size[0] * board_size[1])
+        self.free_cell_positions[:] = range(board_size[0] * board_size[1])
         self.previous_head_location = None
         self.previous_move = None
-        self.head_location = [board_size[0]//2, board_size[1]//2]
-        self.body_locations = []
-        self.apple_location = [board_size[0]//2+2, board_size[1]//2+2]
+        self.head_location = (board_size[0]//2, board_size[1]//2)
+        self.body_locations = deque()  # (x, y) tuples, the tail is at the left end and the neck at the right
+        self.vacated_location = None  # the cell the snake left on its last move (None if it grew)
+        self.exit_moves = {}  # body location -> the move the snake made when leaving it (sets the sprite direction)
+        self.changed_locations = set()  # cells whose sprite may have changed since the last frame was drawn
+        self.apple_location = (board_size[0]//2+2, board_size[1]//2+2)
         
         # Sets up the board
         self.initialize_board()
         self.is_alive = True  # ahh, life : )
+        self.has_won = False
+        self.n_moves = 0  # accepted moves so far
+        return None
 
 
     def _convert_keypress_to_str(self, keypress_value):
@@ -250,39 +938,22 @@ class Snake():
     
     def update_from_new_move(self, new_direction: Union[str, int]):
         """Returns False if move is invalid, otherwise Returns True"""
-        self.previous_head_location = self.head_location.copy()
+        self.previous_head_location = self.head_location
         if isinstance(new_direction, int):
             # convert new_direction to a str \in {"down", "up", "left", "right"} or None if invalid
             new_direction = self._convert_keypress_to_str(new_direction)
 
         # Recording move
-        if new_direction is None:
+        if new_direction not in MOVE_DELTAS:
             return False  # move is invalid
-        if new_direction == 'up':
-            if self.previous_move == 'down':
-                print(f'You cannot go down since you just went up.')
-                return False
-            self.head_location[1] -= 1
-            
-        elif new_direction == 'down':
-            if self.previous_move == 'up':
-                    print(f'You cannot go down since you just went up.')
-                    return False
-            self.head_location[1] += 1
-            
-        elif new_direction == 'left':
-            if self.previous_move == 'right':
-                print(f'You cannot go left since you just went right.')
-                return False
-            self.head_location[0] -= 1
-            
-        elif new_direction == 'right':            
-            if self.previous_move == 'left':
-                print(f'You cannot go right since you just went left.')
-                return False
-            self.head_location[0] += 1
-        
+        if self.previous_move == OPPOSITE_MOVES[new_direction]:
+            logger.debug('You cannot go %s since you just went %s.', new_direction, self.previous_move)
+            return False
+        delta_x, delta_y = MOVE_DELTAS[new_direction]
+        self.head_location = (self.head_location[0] + delta_x, self.head_location[1] + delta_y)
+
         self.previous_move = new_direction
+        self.n_moves += 1
         
         if self.check_for_death():
             # the snake is dead, long live the apple!
@@ -290,46 +961,164 @@ class Snake():
         else:
             did_eat = self.check_for_growth()
             self.update_body_locations(is_growing=did_eat)
-            if did_eat:
-                self.make_new_apple()
+            if did_eat and not self.make_new_apple():
+                # there is nowhere left to put an apple, the snake fills the whole board!
+                self.has_won = True
             self.update_board_arr()
 
-        # TODO: make check for win : )
         return True  # returning True means valid move has been recorded
     
     def update_body_locations(self, is_growing: bool):
-        """roll over body locations"""
+        """roll over body locations (and the occupancy grid) in O(1)"""
+        self._occupy_cell(self.head_location)
+        self.exit_moves[self.previous_head_location] = self.previous_move
+        self.changed_locations.update((self.head_location, self.previous_head_location))
         if is_growing:
             self.body_locations.append(self.previous_head_location)
-            return None
-        
-        if len(self.body_locations) == 0:
-            # the snake has no body :0
+            self.vacated_location = None
             return None
 
-        # if it has a body and is not growing, 
-        # remove the oldest body part and add previous head location to the body
-        if len(self.body_locations) > 1:
-            self.body_locations.pop(0)  # remove the oldest body part
-            self.body_locations.append(self.previous_head_location)  # add the previous head to the body
+        if len(self.body_locations) == 0:
+            # the snake has no body :0, so it just leaves the cell its head was in
+            self.vacated_location = self.previous_head_location
         else:
-            self.body_locations = [self.previous_head_location]
+            # if it has a body and is not growing,
+            # remove the oldest body part and add previous head location to the body
+            self.vacated_location = self.body_locations.popleft()
+            self.body_locations.append(self.previous_head_location)
+            self.changed_locations.add(self.body_locations[0])  # the new tail
+        self._free_cell(self.vacated_location)
+        self.changed_locations.add(self.vacated_location)
         return None
-    
-    def make_new_apple(self):
-        self.apple_location = [self.rng.randint(low=0, high=self.board.shape[-2]),
-                               self.rng.randint(low=0, high=self.board.shape[-1])]
-        while self.apple_location in self.body_locations + [self.head_location]:
-            self.make_new_apple()
+
+    def _occupy_cell(self, location):
+        """marks `location` as part of the snake and swap-removes it from the free cells"""
+        self.occupancy[location] = True
+        cell = location[0] * self.board.shape[-1] + location[1]
+        position = self.free_cell_positions[cell]
+        last_cell = self.free_cells[-1]
+        self.free_cells[position] = last_cell
+        self.free_cell_positions[last_cell] = position
+        self.free_cells.pop()
         return None
+
+    def _free_cell(self, location):
+        """marks `location` as empty again and appends it to the free cells"""
+        self.occupancy[location] = False
+        cell = location[0] * self.board.shape[-1] + location[1]
+        self.free_cell_positions[cell] = len(self.free_cells)
+        self.free_cells.append(cell)
+        return None
+    
+    def make_new_apple(self) -> bool:
+        """Places the apple on a uniformly random free cell in O(1).
+        Returns False (and leaves the apple where it is) if the board is full."""
+        if len(self.free_cells) == 0:
+            return False
+        cell = self.free_cells[self.rng.randint(low=0, high=len(self.free_cells))]
+        self.apple_location = divmod(cell, self.board.shape[-1])
+        self.changed_locations.add(self.apple_location)
+        return True
         
+    def make_keyframe(self) -> dict:
+        """Snapshot of everything needed to continue the game exactly (see `load_keyframe`)"""
+        return dict(head_location=self.head_location,
+                    body_locations=np.array(self.body_locations, dtype=np.int32).reshape(-1, 2),
+                    apple_location=self.apple_location,
+                    previous_move=self.previous_move,
+                    # the order of the free cells decides where the next apples go, so it is part of the state
+                    free_cells=np.array(self.free_cells, dtype=np.int32),
+                    rng_state=self.rng.get_state(),
+                    is_alive=self.is_alive,
+                    has_won=self.has_won,
+                    n_moves=self.n_moves)
+
+    def load_keyframe(self, keyframe: dict):
+        """Restores a `make_keyframe` snapshot, rebuilding the occupancy grid, free cell index and board"""
+        self.head_location = tuple(keyframe['head_location'])
+        self.body_locations = deque(map(tuple, np.asarray(keyframe['body_locations']).tolist()))
+        self.apple_location = tuple(keyframe['apple_location'])
+        self.previous_move = keyframe['previous_move']
+        self.previous_head_location = self.body_locations[-1] if self.body_locations else None
+        self.vacated_location = None
+        self.rng.set_state(keyframe['rng_state'])
+        self.is_alive = keyframe['is_alive']
+        self.has_won = keyframe['has_won']
+        self.n_moves = keyframe.get('n_moves', self.n_moves)
+
+        self.free_cells = np.asarray(keyframe['free_cells']).tolist()
+        self.free_cell_positions = [0] * self.occupancy.size
+        for position, cell in enumerate(self.free_cells):
+            self.free_cell_positions[cell] = position
+
+        # the move out of each body part is the step to the next part (the one closer to the head)
+        moves_by_delta = {delta: move for move, delta in MOVE_DELTAS.items()}
+        snake_locations = [*self.body_locations, self.head_location]
+        if not self.is_alive and self.previous_move is not None:
+            # the head of a dead snake made its last move without the body following, so the cell it came from
+            # is still part of the snake
+            delta_x, delta_y = MOVE_DELTAS[self.previous_move]
+            self.previous_head_location = (self.head_location[0] - delta_x, self.head_location[1] - delta_y)
+            snake_locations.insert(-1, self.previous_head_location)
+        self.exit_moves = {location: moves_by_delta[(next_location[0] - location[0], next_location[1] - location[1])]
+                           for location, next_location in zip(snake_locations, snake_locations[1:])}
+        if not self.is_on_board(self.head_location):
+            snake_locations.pop()  # a snake that died by running into a wall has its head off the board
+        self.changed_locations = set(snake_locations) | {self.apple_location}
+
+        self.occupancy.fill(False)
+        self.board.fill(0)
+        for location in snake_locations:
+            self.occupancy[location] = True
+            self.board[:, location[0], location[1]] = 255
+        self.board[0, self.apple_location[0], self.apple_location[1]] = 255
+        return None
+
+    def is_on_board(self, location) -> bool:
+        return 0 <= location[0] < self.board.shape[1] and 0 <= location[1] < self.board.shape[2]
+
+    def snapshot(self) -> SnakeState:
+        """Returns a compact, immutable copy of the game (see `snake_state.py`), e.g. to fork it for tree search"""
+        height = self.board.shape[-1]
+        occupancy_bytes = np.packbits(self.occupancy.ravel(), bitorder='little').tobytes()
+        return SnakeState(board_size=tuple(self.board.shape[1:]),
+                          head_location=self.head_location,
+                          trail=array('l', [x * height + y for x, y in self.body_locations]),
+                          start=0,
+                          end=len(self.body_locations),
+                          occupancy=int.from_bytes(occupancy_bytes, 'little'),
+                          apple_cell=self.apple_location[0] * height + self.apple_location[1],
+                          previous_move=ACTION_TO_ID.get(self.previous_move, NO_ACTION),
+                          is_alive=self.is_alive,
+                          has_won=self.has_won,
+                          n_steps=self.n_moves,
+                          seed=self.random_seed)
+
+    def restore(self, state: SnakeState):
+        """Puts the game into `state` (from `snapshot` or `snake_state.step`).
+        Apples spawned after this come from this snake's own RNG."""
+        assert tuple(state.board_size) == tuple(self.board.shape[1:]), 'the state is for a different board size'
+        n_cells = self.occupancy.size
+        occupancy_bytes = np.frombuffer(state.occupancy.to_bytes((n_cells + 7) // 8, 'little'), dtype=np.uint8)
+        occupancy = np.unpackbits(occupancy_bytes, count=n_cells, bitorder='little').astype(bool)
+        self.load_keyframe(dict(head_location=state.head_location,
+                                body_locations=np.array(state.body_locations, dtype=np.int32).reshape(-1, 2),
+                                apple_location=state.apple_location,
+                                previous_move=ACTIONS[state.previous_move] if state.previous_move != NO_ACTION else None,
+                                free_cells=np.flatnonzero(~occupancy),
+                                rng_state=self.rng.get_state(),
+                                is_alive=state.is_alive,
+                                has_won=state.has_won,
+                                n_moves=state.n_steps))
+        return None
+
     def check_for_death(self):
         """Takes in the current game state, and sees if there are any conflicts (i.e. deaths)"""
         for head_location, board_size in zip(self.head_location, self.board.shape[1:]):
             if head_location < 0 or head_location >= board_size:
                 # the snake's head has run into a wall (hopefully it has insurance)
                 return True
-        if self.head_location in self.body_locations:
+        if self.occupancy[self.head_location]:
             # the snake has run into itself (it's super effective)
             return True
         # if none of the above are True, then the snake has lived to fight another frame
@@ -345,101 +1134,75 @@ class Snake():
 
     ## BOARD FUNCTIONS                
     def initialize_board(self):
+        self._occupy_cell(self.head_location)
         self.board[:, self.head_location[0], self.head_location[1]] = 255
         self.board[0, self.apple_location[0], self.apple_location[1]] = 255
         return None
     
     def update_board_arr(self):
-        # TODO: make this more efficient and not re-create the whole board array each time.
-        self.board = np.zeros([3, *self.board.shape[1:]], dtype=np.uint8)
-        for body_location in self.body_locations:
-            self.board[:, body_location[0], body_location[1]] = 255
+        """Updates the board in place: only the vacated cell, the new head and the apple can change"""
+        if self.vacated_location is not None:
+            self.board[:, self.vacated_location[0], self.vacated_location[1]] = 0
         self.board[:, self.head_location[0], self.head_location[1]] = 255
         self.board[0, self.apple_location[0], self.apple_location[1]] = 255
         return None
 
-    def prepare_board_for_displaying(self, wanted_size):
-        # return resize(np.moveaxis(self.board, 0, -1), output_shape=(wanted_size) + [3, ], 
-        #               mode='constant', order=0,
-        #               anti_aliasing=False, preserve_range=True).astype(np.uint8)
-        display_board  = np.zeros(wanted_size + [3,], dtype=np.uint8)
-        # Getting sprites for head
-        direction = self._check_body_direction(self.head_location, is_head=True)
-        head_type = self._check_body_type(self.head_location, is_head=True)
-        head_sprite = self.sprites[f'{head_type}-{direction}']
-        # getting apple sprite
-        apple_sprite = self.sprites['apple']
-        #getting body sprites
-        body_sprites = []
-        for body_location in self.body_locations:
-            direction = self._check_body_direction(body_location)
-            body_type = self._check_body_type(body_location)
-            body_sprites.append(self.sprites[f'{body_type}-{direction}'])
-        all_locations = [self.head_location] + [self.apple_location] + self.body_locations
-        all_sprites = [head_sprite] + [apple_sprite] + body_sprites
-
-        # Render the sprites onto the display board
-        # TODO: check if this can be made this more efficient?
-        for location, sprite in zip(all_locations, all_sprites):
-            display_board[location[0]*sprite.shape[0]:(location[0]+1)*sprite.shape[0],
-                          location[1]*sprite.shape[1]:(location[1]+1)*sprite.shape[1], ...] = sprite
-        
-        return display_board
-
-    def _check_body_direction(self, body_location, is_head=False) -> str:
-        """Determines the direction a specific body part is going, 
-        where `direction` \in {'up', 'right', 'down' left'}"""
-        if is_head:
-            # the head direction will be whatever direction the snake is moving, unless it is the first move
-            # in that case, default to up
-            return self.previous_move if self.previous_move is not None else 'up'
-        # If not head, a the direction of a body location is determined by the part that is next closest to head
-        body_idx = self.body_locations.index(body_location)
-        if body_idx == len(self.body_locations)-1:
-            # the reference body part (the part that is next closest to the head), is the head
-            reference_body_location = self.head_location
-        else:
-            reference_body_location = self.body_locations[body_idx + 1]
-        scaled_location_distance = (
-            (np.array(body_location) - np.array(reference_body_location)) * np.array([1, 2]) ).sum()
-        if scaled_location_distance > 0:
-            if scaled_location_distance == 2:     
-                direction = 'left'
-            else:  # scaled location distance == 1
-                direction = 'down'
-        else:
-            if scaled_location_distance == -2:
-                direction = 'right'
-            else:  # scaled location distance == -1
-                direction = 'up'
-        return direction
-
-
-    def _check_body_type(self, body_location, is_head=False) -> str:
-        """Determines the body type at the current `body_location`. 
-        Returns either: `head`, `body`, `tail`, or `unibody`."""
-        if is_head:
-            # TODO: add a unibody sprite which has a left, right, up, and down
-            # # Check if a body does not exist
-            # if len(self.body_locations) == 0:
-            #     return 'unibody'
-            # else:
-            #     return 'head'
-            return 'head'
-
-        # Check if body part is tail (which is at the beginning of the body array)
-        if body_location == self.body_locations[0]:
-            return 'tail'
-        else:
-            return 'body'
+    def get_sprite_key(self, location):
+        """Returns the key of the sprite drawn at `location` (or None for an empty cell) in O(1).
+        Gives the same sprites as `prepare_board_for_displaying`, one cell at a time."""
+        if location == self.apple_location:
+            return 'apple'
+        if location == self.head_location:
+            return f'head-{self._get_head_direction()}'
+        if not self.occupancy[location]:
+            return None
+        body_type = 'tail' if location == self.body_locations[0] else 'body'
+        return f'{body_type}-{BODY_SPRITE_DIRECTIONS[self.exit_moves[location]]}'
+
+    def prepare_board_for_displaying(self, wanted_size, out=None, top_left=(0, 0)):
+        """Composites every sprite onto a `wanted_size + [3]` image in one vectorized pass.
+        The image is written into `out`, or into a buffer that is reused between calls (so copy it to keep it).
+        Only the cells from `top_left` on that fit in the image are drawn, so it also works as a camera view
+        of a board that is bigger than the image."""
+        if out is None:
+            if self._display_buffer is None or list(self._display_buffer.shape[:2]) != list(wanted_size):
+                self._display_buffer = np.zeros(list(wanted_size) + [3,], dtype=np.uint8)
+            out = self._display_buffer
+        out.fill(0)
+        locations, sprite_ids = self.get_sprite_ids()
+
+        # View the image as a grid of sprite-sized tiles and write all the sprites with one fancy-indexed assignment.
+        # The head is first and the body last, so (like before) later sprites win if cells overlap.
+        sprite_width, sprite_height = self.sprite_atlas.shape[1:3]
+        n_x, n_y = wanted_size[0] // sprite_width, wanted_size[1] // sprite_height
+        tiles = out[:n_x*sprite_width, :n_y*sprite_height].reshape(n_x, sprite_width, n_y, sprite_height, 3)
+        locations = locations - np.array(top_left)
+        in_view = (locations >= 0).all(axis=1) & (locations < np.array([n_x, n_y])).all(axis=1)
+        locations, sprite_ids = locations[in_view], sprite_ids[in_view]
+        tiles[locations[:, 0], :, locations[:, 1]] = self.sprite_atlas[sprite_ids]
+        return out
+
+    def get_sprite_ids(self):
+        """Returns the `(n, 2)` locations and matching `SPRITE_KEYS` ids of the head, apple and every body part.
+        Body directions come from the diffs between consecutive body parts, all computed at once."""
+        body = np.array(self.body_locations, dtype=np.int64).reshape(-1, 2)
+        next_parts = np.concatenate([body[1:], [self.head_location]])  # the part that is next closest to the head
+        scaled_location_distances = ((body - next_parts) * np.array([1, 2])).sum(axis=1)
+        body_ids = BODY_SPRITE_IDS[scaled_location_distances + 2]
+        body_ids[:1] = TAIL_SPRITE_IDS[scaled_location_distances[:1] + 2]  # the tail is the oldest body part
+
+        head_id = SPRITE_KEY_IDS[f'head-{self._get_head_direction()}']
+        locations = np.concatenate([[self.head_location, self.apple_location], body])
+        sprite_ids = np.concatenate([[head_id, SPRITE_KEY_IDS['apple']], body_ids])
+        return locations, sprite_ids
+
+    def _get_head_direction(self) -> str:
+        """The direction the snake is moving in, or 'up' before the first move"""
+        return self.previous_move if self.previous_move is not None else 'up'
 
     @staticmethod
     def get_sprites(sprite_filepath, sprite_size) -> dict:
-        sprite_sheet = plt.imread(sprite_filepath)
-        sprites = [[(sprite_sheet[x_idx:x_idx+sprite_size[0], y_idx:y_idx+sprite_size[1], :3] * 255).astype(np.uint8)
-                        for y_idx in range(0, sprite_sheet.shape[1], sprite_size[1])]
-                            for x_idx in range(0, sprite_sheet.shape[0], sprite_size[0])]
-        sprites = sum(sprites, [])  # shape: (n_sprites, width, height)
+        sprites = Snake.load_sprite_sheet(sprite_filepath, sprite_size)  # shape: (n_sprites, width, height, 3)
         sprite_dict = {
             'head-up': sprites[3],
             'head-right': sprites[2],
@@ -457,58 +1220,105 @@ class Snake():
         }
         return sprite_dict
 
-    def update_output_image(self, output_image, output_slice, xy_in_UID):
-        # Only update output image if current value is not 0  (i.e. is not empty)
-        if xy_in_UID != 0:
-            sprite = self.get_sprite_for_unit_id(xy_in_UID)
-            output_image[output_slice[0], output_slice[1]] = sprite
-        return output_image
+    @staticmethod
+    def load_sprite_sheet(sprite_filepath, sprite_size) -> np.ndarray:
+        """Returns the sheet's sprites (in reading order) scaled to `sprite_size`. The result is kept in memory and
+        saved as a `.npy` keyed by sprite size and the sheet's mtime, so only the first load decodes the image."""
+        sprite_filepath = Path(sprite_filepath)
+        sheet_mtime = sprite_filepath.stat().st_mtime_ns
+        cache_key = (str(sprite_filepath.resolve()), sheet_mtime, tuple(sprite_size))
+        if cache_key in _loaded_sprite_sheets:
+            return _loaded_sprite_sheets[cache_key]
+
+        cache_path = (sprite_filepath.parent / SPRITE_CACHE_DIR_NAME
+                      / f'{sprite_filepath.stem}-{sprite_size[0]}x{sprite_size[1]}-{sheet_mtime}.npy')
+        sprites = None
+        if cache_path.exists():
+            try:
+                sprites = np.load(cache_path)
+            except (OSError, ValueError, EOFError) as error:
+                logger.warning(f'Ignoring the broken sprite cache {cache_path} ({error})')
+        if sprites is None:
+            sprites = Snake._slice_sprite_sheet(sprite_filepath, sprite_size)
+            try:
+                cache_path.parent.mkdir(exist_ok=True)
+                # written under a unique name and then renamed, so other processes (or a crash) never see half a file
+                with tempfile.NamedTemporaryFile(dir=cache_path.parent, suffix='.tmp', delete=False) as temp_file:
+                    np.save(temp_file, sprites)
+                os.replace(temp_file.name, cache_path)
+            except OSError:
+                pass  # e.g. a read-only install, the sheet just gets decoded every time
+        _loaded_sprite_sheets[cache_key] = sprites
+        return sprites
+
+    @staticmethod
+    def _slice_sprite_sheet(sprite_filepath, sprite_size) -> np.ndarray:
+        # surfarray arrays are indexed (x, y), so swap them to get the (row, column) layout of an image array
+        sprite_sheet = pygame.surfarray.array3d(pygame.image.load(str(sprite_filepath))).swapaxes(0, 1)
+        n_rows, n_columns = SPRITE_SHEET_GRID
+        tile_size = (sprite_sheet.shape[0] // n_rows, sprite_sheet.shape[1] // n_columns)
+        tiles = (sprite_sheet[:n_rows*tile_size[0], :n_columns*tile_size[1]]
+                 .reshape(n_rows, tile_size[0], n_columns, tile_size[1], 3)
+                 .swapaxes(1, 2).reshape(n_rows * n_columns, *tile_size, 3))
+        # nearest neighbour scaling of the tiles to the wanted sprite size
+        row_idxs = np.arange(sprite_size[0]) * tile_size[0] // sprite_size[0]
+        column_idxs = np.arange(sprite_size[1]) * tile_size[1] // sprite_size[1]
+        return np.ascontiguousarray(tiles[:, row_idxs][:, :, column_idxs])
+
+    @staticmethod
+    def make_sprite_atlas(sprites: dict) -> np.ndarray:
+        """Stacks the sprites into a `(len(SPRITE_KEYS), width, height, 3)` array indexed by sprite id"""
+        empty_sprite = np.zeros_like(sprites['apple'])
+        return np.stack([empty_sprite] + [sprites[sprite_key] for sprite_key in SPRITE_KEYS[1:]])
 
     def get_sprite_for_unit_id(self, unit_id):
-        if isinstance(unit_id, torch.Tensor):
-            unit_id = unit_id.item()
-        sprite_idx = UNIT_ID_TO_SPRITE_IDX[unit_id]
-        return SPRITES[sprite_idx]
+        """Returns the sprite for a unit id (an index into `SPRITE_KEYS`, 0 being an empty cell)"""
+        return self.sprite_atlas[int(unit_id)]
 
-    def expand_and_sprite_image(self, input_image, output_image, w_out, h_out):
-        assert input_image.ndim == 2, 'Only 2d (i.e. grayscale) images are supported'
-        
-        w_in, h_in = input_image.shape[-2:]
-
-        w_scale = int(w_out / w_in)
-        h_scale = int(h_out / h_in)
-        assert w_scale>1 and h_scale>1, 'Only upscaling is supported.'
-
-        for y_out in range(0, h_out, h_scale):
-            for x_out in range(0, w_out, w_scale):
-                # Finding the coordinates relative to the input space
-                x_in = x_out // w_scale
-                y_in = y_out // h_scale
-
-                # finding slice of output pixel space which represents x_in, y_in
-                x_in_next = min(x_in+1, w_in)  # making sure we don't go beyond the output image
-                y_in_next = min(y_in+1, h_in)  # making sure we don't go beyond the output image
-                output_slice = [slice(x_out, (x_in_next*w_scale)),
-                                slice(y_out, (y_in_next*h_scale))]
-
-                # get sprite+color which corresponds to value_of_xy_in
-                output_image = self.update_output_image(output_image, output_slice)
-                
+    def get_unit_id_grid(self, out=None) -> np.ndarray:
+        """Returns the current frame as a `board_size` grid of unit ids, which is a compact way to store
+        observations that can be turned back into images later with `expand_and_sprite_image`"""
+        if out is None:
+            out = np.zeros(self.board.shape[1:], dtype=np.uint8)
+        else:
+            out.fill(0)
+        locations, sprite_ids = self.get_sprite_ids()
+        # the head of a snake that ran into a wall is off the board (and a negative index would wrap around)
+        on_board = (locations >= 0).all(axis=1) & (locations < np.array(out.shape)).all(axis=1)
+        out[locations[on_board, 0], locations[on_board, 1]] = sprite_ids[on_board]
+        return out
+
+    def expand_and_sprite_image(self, input_image, output_image=None):
+        """Upscales a `(w_in, h_in)` grid of unit ids (or a batch of them, `(n, w_in, h_in)`) to the sprited
+        `(..., w_in*sprite_width, h_in*sprite_height, 3)` RGB image with a single gather from `sprite_atlas`.
+        The result is written into `output_image` if given (which has to be C-contiguous)."""
+        input_image = np.asarray(input_image)
+        assert input_image.ndim in (2, 3), 'Only 2d unit id grids (or a batch of them) are supported'
+        *batch_shape, w_in, h_in = input_image.shape
+        w_scale, h_scale = self.sprite_atlas.shape[1:3]
+        if output_image is None:
+            output_image = np.empty([*batch_shape, w_in*w_scale, h_in*h_scale, 3], dtype=np.uint8)
+        assert output_image.flags.c_contiguous, 'output_image has to be C-contiguous to be written in place'
+
+        # (..., w_in, h_in, w_scale, h_scale, 3) sprites -> (..., w_in, w_scale, h_in, h_scale, 3) pixel blocks,
+        # which is the output image once the block axes are merged back together
+        output_blocks = output_image.reshape(*batch_shape, w_in, w_scale, h_in, h_scale, 3)
+        output_blocks[...] = self.sprite_atlas[input_image].swapaxes(-4, -3)
         return output_image
 
-def start_game():
-    game_size = (512, 512)
-    board_size = (32, 32)
+def start_game(board_size=(32, 32), game_size=(512, 512), video_format=None):
     screen = pygame.display.set_mode((game_size[0], game_size[1]+HEADER_HEIGHT_OFFSET))
     
-    snake = Snake(board_size=board_size, sprite_size=(game_size[0]//board_size[0], game_size[1]//board_size[1]),
-                  random_seed=None,)
-    game = Game(snake, screen, record_dir='./game_saves')
-    game.run_game()           
+    # sprites are scaled to fit the board on screen, but never below MIN_SPRITE_SIZE: bigger boards scroll instead
+    sprite_size = tuple(max(game_cells // board_cells, MIN_SPRITE_SIZE) for game_cells, board_cells in zip(game_size, board_size))
+    snake = Snake(board_size=board_size, sprite_size=sprite_size, random_seed=None,)
+    game = Game(snake, screen, record_dir='./game_saves', video_format=video_format)
+    game.run_session()           
 
 
 
 if __name__ == '__main__':      
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     pygame.init()
     pygame.display.set_caption('Snake')  
     start_game()
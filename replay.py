@@ -0,0 +1,288 @@
+"""Compact binary game recordings and deterministic playback.
+
+A replay file is a fixed-size header (seed, board size, number of moves) followed by the accepted moves
+packed 2 bits each (ids from `vec_snake.ACTIONS`, 4 moves per byte, oldest move in the lowest bits).
+Snapshots of the game state are appended every `keyframe_interval` moves to a `.keyframes` file next to it,
+so a game can be rebuilt at any tick without replaying it from the start. A keyframe is a fixed-size header
+followed by the random generator's key and the order of the free cells; the body isn't stored, since it is
+where the head was over the last moves, which are in the replay.
+"""
+import queue
+import struct
+import threading
+from array import array
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from game_module import import_game_module
+from vec_snake import ACTIONS, ACTION_DELTAS, ACTION_TO_ID
+
+REPLAY_MAGIC = b'SNAKEREP'
+REPLAY_VERSION = 1
+# magic, version, board width, board height, keyframe interval, random seed, number of moves
+_HEADER_FORMAT = '<8sIIIIQQ'
+_N_MOVES_OFFSET = struct.calcsize('<8sIIIIQ')
+HEADER_SIZE = 64  # the header is padded so the packed moves start at an aligned offset
+MOVES_PER_BYTE = 4
+
+KEYFRAME_MAGIC = b'SNAKEKFR'
+# magic, tick, head x, head y, apple x, apple y, body length, previous move id (-1 for none), is alive, has won,
+# random generator position, has gauss, cached gaussian, number of free cells
+_KEYFRAME_HEADER_FORMAT = '<8sQiiiiQbBBiidQ'
+KEYFRAME_HEADER_SIZE = struct.calcsize(_KEYFRAME_HEADER_FORMAT)
+RNG_KEY_SIZE = 624  # uint32 words of the MT19937 key
+KEYFRAME_WRITE_CHUNK_SIZE = 16384  # free cells converted and written at once, so the writer often lets the game run
+
+
+def keyframes_path_for(replay_path: Path) -> Path:
+    return replay_path.with_suffix('.keyframes')
+
+
+class ReplayRecorder():
+    """Writes one game to `replay_path` while it is being played.
+
+    Call `record(snake)` after every accepted move and `close()` when the game is over. Moves are
+    buffered and written out in chunks of `chunk_size` bytes, and the header's move count is updated
+    on every flush so a crash loses at most one chunk. Keyframes only copy the free cell order on the
+    game loop, and are written to the `.keyframes` file by a background thread as soon as they are taken.
+    """
+
+    def __init__(self, replay_path, random_seed: int, board_size, keyframe_interval=1024, chunk_size=4096) -> None:
+        self.replay_path = Path(replay_path)
+        self.replay_path.parent.mkdir(parents=True, exist_ok=True)
+        self.random_seed = random_seed
+        self.board_size = tuple(board_size)
+        self.keyframe_interval = keyframe_interval
+        self.chunk = bytearray(chunk_size)
+        self.n_moves = 0
+        self.n_flushed_bytes = 0
+        self.file = open(self.replay_path, 'wb')
+        self.file.write(self._make_header(n_moves=0))
+        self.keyframes_file = None
+        self.pending_keyframes = queue.Queue()
+        self.keyframe_writer = None
+        if self.keyframe_interval:
+            self.keyframes_file = open(keyframes_path_for(self.replay_path), 'wb')
+            self.keyframe_writer = threading.Thread(target=self._write_keyframes, name='keyframe-writer', daemon=True)
+            self.keyframe_writer.start()
+        return None
+
+    def _make_header(self, n_moves) -> bytes:
+        header = struct.pack(_HEADER_FORMAT, REPLAY_MAGIC, REPLAY_VERSION, *self.board_size,
+                             self.keyframe_interval, self.random_seed, n_moves)
+        return header.ljust(HEADER_SIZE, b'\0')
+
+    def record(self, snake):
+        """Appends the move `snake` just made (its `previous_move`), and a keyframe every `keyframe_interval` moves"""
+        byte_idx, slot = divmod(self.n_moves, MOVES_PER_BYTE)
+        chunk_idx = byte_idx - self.n_flushed_bytes
+        if chunk_idx == len(self.chunk):
+            self.flush()
+            chunk_idx = 0
+        self.chunk[chunk_idx] |= ACTION_TO_ID[snake.previous_move] << (2 * slot)
+        self.n_moves += 1
+        if self.keyframe_interval and self.n_moves % self.keyframe_interval == 0 and snake.is_alive:
+            self.take_keyframe(snake)
+        return None
+
+    def take_keyframe(self, snake):
+        """Queues a keyframe of `snake` for the writer thread, copying only what later moves would change"""
+        _, rng_key, rng_position, has_gauss, cached_gaussian = snake.rng.get_state()
+        previous_move_id = ACTION_TO_ID[snake.previous_move] if snake.previous_move is not None else -1
+        header = struct.pack(_KEYFRAME_HEADER_FORMAT, KEYFRAME_MAGIC, self.n_moves, *snake.head_location,
+                             *snake.apple_location, len(snake.body_locations), previous_move_id, snake.is_alive,
+                             snake.has_won, rng_position, has_gauss, cached_gaussian, len(snake.free_cells))
+        self.pending_keyframes.put((header, rng_key, snake.free_cells.copy()))
+        return None
+
+    def _write_keyframes(self):
+        while (keyframe := self.pending_keyframes.get()) is not None:
+            header, rng_key, free_cells = keyframe
+            self.keyframes_file.write(header)
+            self.keyframes_file.write(rng_key.astype('<u4').tobytes())
+            for start in range(0, len(free_cells), KEYFRAME_WRITE_CHUNK_SIZE):
+                self.keyframes_file.write(array('i', free_cells[start:start + KEYFRAME_WRITE_CHUNK_SIZE]))
+            self.keyframes_file.flush()
+        return None
+
+    def flush(self):
+        """Writes out every complete byte of the buffered moves"""
+        n_complete_bytes = self.n_moves // MOVES_PER_BYTE - self.n_flushed_bytes
+        self.file.write(self.chunk[:n_complete_bytes])
+        self.n_flushed_bytes += n_complete_bytes
+        # a partially filled last byte stays at the front of the buffer
+        leftover = self.chunk[n_complete_bytes] if n_complete_bytes < len(self.chunk) else 0
+        self.chunk[:] = bytes(len(self.chunk))
+        self.chunk[0] = leftover
+        self._write_n_moves(self.n_flushed_bytes * MOVES_PER_BYTE)
+        return None
+
+    def _write_n_moves(self, n_moves):
+        self.file.seek(_N_MOVES_OFFSET)
+        self.file.write(struct.pack('<Q', n_moves))
+        self.file.seek(0, 2)
+        self.file.flush()
+        return None
+
+    def close(self):
+        if self.file.closed:
+            return None
+        n_pending_bytes = -(-self.n_moves // MOVES_PER_BYTE) - self.n_flushed_bytes
+        self.file.write(self.chunk[:n_pending_bytes])
+        self._write_n_moves(self.n_moves)
+        self.file.close()
+        if self.keyframe_writer is not None:
+            self.pending_keyframes.put(None)
+            self.keyframe_writer.join()
+            self.keyframes_file.close()
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Replay():
+    """Read-only view of a recorded game. The packed moves are memory-mapped, so only the parts
+    that are actually played back are read from disk, no matter how large the file is. Likewise only
+    the keyframe headers are read up front, and a keyframe itself is read when `get_keyframe` needs it."""
+
+    def __init__(self, replay_path) -> None:
+        self.replay_path = Path(replay_path)
+        with open(self.replay_path, 'rb') as replay_file:
+            header = replay_file.read(HEADER_SIZE)
+        magic, version, width, height, self.keyframe_interval, self.random_seed, self.n_moves = \
+            struct.unpack_from(_HEADER_FORMAT, header)
+        if magic != REPLAY_MAGIC:
+            raise ValueError(f'{self.replay_path} is not a snake replay')
+        if version != REPLAY_VERSION:
+            raise ValueError(f'Unsupported replay version {version} (expected {REPLAY_VERSION})')
+        self.board_size = (width, height)
+
+        n_bytes = -(-self.n_moves // MOVES_PER_BYTE)
+        if n_bytes > 0:
+            self.packed_moves = np.memmap(self.replay_path, dtype=np.uint8, mode='r', offset=HEADER_SIZE, shape=(n_bytes,))
+        else:
+            self.packed_moves = np.zeros(0, dtype=np.uint8)
+
+        self.keyframes_path = keyframes_path_for(self.replay_path)
+        self.keyframe_ticks, self.keyframe_offsets = self._index_keyframes()
+        return None
+
+    def _index_keyframes(self) -> tuple:
+        """The ticks and file offsets of the keyframes, skipping a partly written last one (from a crash) and any
+        that are past the moves that made it to disk"""
+        ticks, offsets = [], []
+        if not self.keyframes_path.exists():
+            return np.zeros(0, dtype=np.int64), offsets
+        file_size = self.keyframes_path.stat().st_size
+        with open(self.keyframes_path, 'rb') as keyframes_file:
+            offset = 0
+            while offset + KEYFRAME_HEADER_SIZE <= file_size:
+                keyframes_file.seek(offset)
+                magic, tick, *_, n_free_cells = struct.unpack(_KEYFRAME_HEADER_FORMAT,
+                                                              keyframes_file.read(KEYFRAME_HEADER_SIZE))
+                keyframe_size = KEYFRAME_HEADER_SIZE + 4 * (RNG_KEY_SIZE + n_free_cells)
+                if magic != KEYFRAME_MAGIC or offset + keyframe_size > file_size or tick > self.n_moves:
+                    break
+                ticks.append(tick)
+                offsets.append(offset)
+                offset += keyframe_size
+        return np.array(ticks, dtype=np.int64), offsets
+
+    def __len__(self):
+        return self.n_moves
+
+    def get_moves(self, start=0, stop=None) -> np.ndarray:
+        """Unpacks the move ids of ticks `[start, stop)`, touching only the bytes that hold them"""
+        stop = self.n_moves if stop is None else min(stop, self.n_moves)
+        if start >= stop:
+            return np.zeros(0, dtype=np.uint8)
+        first_byte, last_byte = start // MOVES_PER_BYTE, -(-stop // MOVES_PER_BYTE)
+        packed = np.asarray(self.packed_moves[first_byte:last_byte])
+        moves = ((packed[:, None] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3).ravel()
+        return moves[start - first_byte * MOVES_PER_BYTE:stop - first_byte * MOVES_PER_BYTE]
+
+    def get_keyframe(self, tick) -> tuple:
+        """Returns `(keyframe_tick, keyframe)` for the last keyframe at or before `tick` (or `(0, None)`)"""
+        keyframe_idx = np.searchsorted(self.keyframe_ticks, tick, side='right') - 1
+        if keyframe_idx < 0:
+            return 0, None
+        with open(self.keyframes_path, 'rb') as keyframes_file:
+            keyframes_file.seek(self.keyframe_offsets[keyframe_idx])
+            (_, keyframe_tick, head_x, head_y, apple_x, apple_y, body_length, previous_move_id, is_alive, has_won,
+             rng_position, has_gauss, cached_gaussian, n_free_cells) = struct.unpack(
+                _KEYFRAME_HEADER_FORMAT, keyframes_file.read(KEYFRAME_HEADER_SIZE))
+            rng_key = np.fromfile(keyframes_file, dtype='<u4', count=RNG_KEY_SIZE)
+            free_cells = np.fromfile(keyframes_file, dtype='<i4', count=n_free_cells)
+
+        # the body parts are where the head was before each of the last `body_length` moves, the tail the longest ago
+        head_location = (head_x, head_y)
+        head_steps = np.cumsum(ACTION_DELTAS[self.get_moves(keyframe_tick - body_length, keyframe_tick)[::-1]], axis=0)
+        body_locations = (np.array(head_location) - head_steps)[::-1].reshape(-1, 2)
+        keyframe = dict(
+            head_location=head_location,
+            body_locations=body_locations,
+            apple_location=(apple_x, apple_y),
+            previous_move=ACTIONS[previous_move_id] if previous_move_id >= 0 else None,
+            free_cells=free_cells,
+            rng_state=('MT19937', rng_key, rng_position, has_gauss, cached_gaussian),
+            is_alive=bool(is_alive),
+            has_won=bool(has_won),
+            n_moves=keyframe_tick,
+        )
+        return keyframe_tick, keyframe
+
+
+class ReplayPlayer():
+    """Rebuilds recorded games headlessly, as fast as `Snake` can step.
+
+    `snake_cls` is the `Snake` class to rebuild the game with; by default it is imported from `pygame-snake.py`.
+    Any `snake_kwargs` (e.g. `sprite_location`) are passed on to it.
+    """
+
+    def __init__(self, replay: Union[Replay, str, Path], snake_cls=None, chunk_size=65536, **snake_kwargs) -> None:
+        self.replay = replay if isinstance(replay, Replay) else Replay(replay)
+        if snake_cls is None:
+            snake_cls = import_game_module().Snake
+        self.snake_cls = snake_cls
+        self.snake_kwargs = snake_kwargs
+        self.chunk_size = chunk_size
+        return None
+
+    def new_snake(self):
+        """A fresh snake for the recorded game, at tick 0"""
+        return self.snake_cls(board_size=self.replay.board_size, random_seed=self.replay.random_seed, **self.snake_kwargs)
+
+    def seek(self, tick: int):
+        """Returns the game as it was after `tick` moves, starting from the closest keyframe"""
+        tick = min(tick, len(self.replay))
+        snake = self.new_snake()
+        keyframe_tick, keyframe = self.replay.get_keyframe(tick)
+        if keyframe is not None:
+            snake.load_keyframe(keyframe)
+        return self.advance(snake, keyframe_tick, tick)
+
+    def play(self):
+        """Replays the whole game and returns the final `Snake`"""
+        return self.advance(self.new_snake(), 0, len(self.replay))
+
+    def advance(self, snake, start: int, stop: Optional[int] = None):
+        """Applies the recorded moves of ticks `[start, stop)` to `snake`"""
+        stop = len(self.replay) if stop is None else stop
+        for chunk_start in range(start, stop, self.chunk_size):
+            for move_id in self.replay.get_moves(chunk_start, min(chunk_start + self.chunk_size, stop)).tolist():
+                snake.update_from_new_move(ACTIONS[move_id])
+        return snake
+
+    def iter_ticks(self, snake, start: int = 0, stop: Optional[int] = None):
+        """Like `advance`, but yields `snake` after every move (e.g. to render each frame of the game)"""
+        stop = len(self.replay) if stop is None else stop
+        for chunk_start in range(start, stop, self.chunk_size):
+            for move_id in self.replay.get_moves(chunk_start, min(chunk_start + self.chunk_size, stop)).tolist():
+                snake.update_from_new_move(ACTIONS[move_id])
+                yield snake
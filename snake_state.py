@@ -0,0 +1,153 @@
+"""Compact, immutable snake game states for search agents (MCTS, beam search, ...).
+
+`SnakeState` never changes once built; `step(state, action)` returns a new state and leaves the old one
+untouched, so forking a game is just keeping a reference. States are cheap to make because they share
+structure: the body is a `[start, end)` window into an append-only `array` of flat cells (`x * height + y`)
+that all states along one line of play share (it is only copied when two branches append to the same
+trail), and the occupancy grid is a Python int used as a bitboard.
+
+The rules are those of `Snake.update_from_new_move`. Apples are placed by a hash of the state's seed and
+step count, so `step` is a pure function; they don't follow the `Snake` RNG.
+"""
+from array import array
+from typing import Union
+
+from vec_snake import ACTIONS, ACTION_TO_ID, NO_ACTION, ACTION_DELTAS as _ACTION_DELTA_ARRAY
+
+# the reverse of action `a` is `(a + 2) % 4`; the deltas as tuples of plain ints, which are faster to add up here
+ACTION_DELTAS = tuple(tuple(delta) for delta in _ACTION_DELTA_ARRAY.tolist())
+
+_MASK_64 = (1 << 64) - 1
+_APPLE_DRAWS = 32  # random cells tried for a new apple before scanning for the free ones
+
+
+class SnakeState():
+    __slots__ = ('board_size', 'head_location', 'trail', 'start', 'end', 'occupancy', 'apple_cell',
+                 'previous_move', 'is_alive', 'has_won', 'n_steps', 'seed')
+
+    def __init__(self, board_size, head_location, trail, start, end, occupancy, apple_cell,
+                 previous_move=NO_ACTION, is_alive=True, has_won=False, n_steps=0, seed=0) -> None:
+        self.board_size = board_size  # (width, height)
+        self.head_location = head_location  # (x, y)
+        self.trail = trail  # array('l') of flat cells, shared between states
+        self.start = start  # trail index of the tail
+        self.end = end  # trail index one past the neck
+        self.occupancy = occupancy  # int bitboard, bit `x * height + y` is set where the head or body is
+        self.apple_cell = apple_cell  # flat apple cell
+        self.previous_move = previous_move  # action id, or NO_ACTION before the first move
+        self.is_alive = is_alive
+        self.has_won = has_won
+        self.n_steps = n_steps
+        self.seed = seed
+        return None
+
+    @classmethod
+    def new_game(cls, board_size=(16, 16), seed=0):
+        """The starting position of `Snake.__init__`"""
+        width, height = board_size
+        head_location = (width // 2, height // 2)
+        return cls(tuple(board_size), head_location, array('l'), 0, 0,
+                   1 << (head_location[0] * height + head_location[1]),
+                   (width // 2 + 2) * height + height // 2 + 2, seed=seed)
+
+    def _replace(self, **changes) -> 'SnakeState':
+        new_state = object.__new__(SnakeState)
+        for slot in SnakeState.__slots__:
+            setattr(new_state, slot, changes[slot] if slot in changes else getattr(self, slot))
+        return new_state
+
+    @property
+    def body_cells(self) -> array:
+        return self.trail[self.start:self.end]
+
+    @property
+    def body_locations(self) -> list:
+        """`(x, y)` body locations, tail first (like `Snake.body_locations`)"""
+        return [divmod(cell, self.board_size[1]) for cell in self.body_cells]
+
+    @property
+    def apple_location(self) -> tuple:
+        return divmod(self.apple_cell, self.board_size[1])
+
+    @property
+    def score(self) -> int:
+        return self.end - self.start + 1
+
+    @property
+    def is_over(self) -> bool:
+        return not self.is_alive or self.has_won
+
+    def legal_actions(self) -> list:
+        """The action ids that `step` won't reject (everything but reversing into the neck)"""
+        if self.previous_move == NO_ACTION:
+            return [0, 1, 2, 3]
+        return [action_id for action_id in range(4) if action_id != (self.previous_move + 2) % 4]
+
+    def is_occupied(self, location) -> bool:
+        return bool(self.occupancy >> (location[0] * self.board_size[1] + location[1]) & 1)
+
+
+def step(state: SnakeState, action: Union[int, str]) -> SnakeState:
+    """Returns the state after `action` (an id or `'up'`/`'right'`/...; `NO_ACTION` keeps going straight).
+    Rejected moves (reversing into the neck, or any move once the game is over) return `state` itself."""
+    if state.is_over:
+        return state
+    move_id = ACTION_TO_ID[action] if isinstance(action, str) else action
+    if move_id == NO_ACTION:
+        move_id = state.previous_move
+    if move_id == NO_ACTION or (state.previous_move != NO_ACTION and move_id == (state.previous_move + 2) % 4):
+        return state
+
+    width, height = state.board_size
+    delta_x, delta_y = ACTION_DELTAS[move_id]
+    x, y = state.head_location[0] + delta_x, state.head_location[1] + delta_y
+    n_steps = state.n_steps + 1
+    head_cell = x * height + y
+    # Death: off the board, or into a body part (the tail still counts since it moves afterwards)
+    if not (0 <= x < width and 0 <= y < height) or state.occupancy >> head_cell & 1:
+        return state._replace(head_location=(x, y), previous_move=move_id, is_alive=False, n_steps=n_steps)
+
+    old_head_cell = state.head_location[0] * height + state.head_location[1]
+    occupancy = state.occupancy | (1 << head_cell)
+    trail, start, end = state.trail, state.start, state.end
+    is_growing = head_cell == state.apple_cell
+    if is_growing or end > start:
+        # the previous head becomes the newest body part (copy the trail if another state already extended it)
+        if end != len(trail):
+            trail, start, end = trail[start:end], 0, end - start
+        trail.append(old_head_cell)
+        end += 1
+    if not is_growing:
+        vacated_cell = trail[start] if end > start else old_head_cell
+        start = start + 1 if end > start else start
+        occupancy &= ~(1 << vacated_cell)
+        return state._replace(head_location=(x, y), trail=trail, start=start, end=end, occupancy=occupancy,
+                              previous_move=move_id, n_steps=n_steps)
+
+    n_cells = width * height
+    if end - start + 1 == n_cells:
+        # there is nowhere left to put an apple, the snake fills the whole board!
+        return state._replace(head_location=(x, y), trail=trail, start=start, end=end, occupancy=occupancy,
+                              previous_move=move_id, has_won=True, n_steps=n_steps)
+    apple_cell = _sample_free_cell(occupancy, n_cells, state.seed, n_steps)
+    return state._replace(head_location=(x, y), trail=trail, start=start, end=end, occupancy=occupancy,
+                          apple_cell=apple_cell, previous_move=move_id, n_steps=n_steps)
+
+
+def _hash64(value) -> int:
+    """splitmix64 finalizer, a cheap well-mixed hash for deterministic apple placement"""
+    value = (value + 0x9E3779B97F4A7C15) & _MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK_64
+    return value ^ (value >> 31)
+
+
+def _sample_free_cell(occupancy, n_cells, seed, counter) -> int:
+    key = _hash64(seed) ^ (counter << 8)
+    for draw in range(_APPLE_DRAWS):
+        cell = _hash64(key + draw) % n_cells
+        if not occupancy >> cell & 1:
+            return cell
+    # the board is crowded, so pick among the free cells directly
+    free_cells = [cell for cell in range(n_cells) if not occupancy >> cell & 1]
+    return free_cells[_hash64(key + _APPLE_DRAWS) % len(free_cells)]
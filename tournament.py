@@ -0,0 +1,244 @@
+"""Headless tournaments: many seeded games per policy, spread over a process pool.
+
+Every (policy, seed) job is one game of `Snake(random_seed=seed)` played to the end by a policy with the
+autopilot signature `policy(snake) -> move` (see `autopilot.py`). Workers are started once: each imports the
+game, loads the sprite sheet and builds every policy up front, then plays batches of seeds and sends the
+results back as packed `RESULT_DTYPE` records, one pipe message per batch.
+
+The parent appends every batch to the results file as it arrives and folds it into running statistics, and
+the manifest next to it (`.json`) is checkpointed with the run settings and the statistics so far. Running
+again with the same results file skips the games that are already in it, so an interrupted run resumes.
+
+    python tournament.py --policies hamiltonian a-star --seeds 10000
+    python tournament.py --policies my_agents:make_policy --board-size 32 32 --results runs/my_agents.results
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import signal
+import time
+from pathlib import Path
+
+import numpy as np
+
+from autopilot import SOLVERS, make_autopilot, play_game
+from game_history import OUTCOMES, get_outcome
+from game_module import import_game_module
+
+RESULT_DTYPE = np.dtype([('policy', '<u2'), ('seed', '<u8'), ('score', '<u4'), ('steps', '<u4'), ('cause', 'u1')])
+CAUSES = OUTCOMES  # how a game ended (see `game_history.get_outcome`), `RESULT_DTYPE['cause']` indexes this
+SPRITE_PATH = Path(__file__).with_name('snake-sprites.png')
+CHECKPOINT_INTERVAL_S = 10  # how often the manifest (with the statistics so far) is rewritten
+
+_worker_state = {}  # set up once per worker process by `_init_worker`
+
+
+def load_policy(policy_spec):
+    """A policy by name (one of `autopilot.SOLVERS`), or a `module:factory` path to a function that makes one"""
+    if ':' in policy_spec:
+        module_name, factory_name = policy_spec.split(':', 1)
+        return getattr(importlib.import_module(module_name), factory_name)()
+    return make_autopilot(policy_spec)
+
+
+def manifest_path_for(results_path: Path) -> Path:
+    return results_path.with_suffix('.json')
+
+
+def _init_worker(policy_specs, board_size, max_moves):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is handled by the parent, which stops the pool
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    snake_game = import_game_module()
+    snake_game.Snake.get_sprites(SPRITE_PATH, (16, 16))  # fills the process's sprite sheet cache for every game
+    _worker_state.update(snake_cls=snake_game.Snake,
+                         policies=[load_policy(policy_spec) for policy_spec in policy_specs],
+                         board_size=tuple(board_size),
+                         max_moves=max_moves)
+    return None
+
+
+def _play_batch(job) -> bytes:
+    """Plays the seeds of one `(policy index, seeds)` job in a worker, returning the packed results"""
+    policy_idx, seeds = job
+    policy = _worker_state['policies'][policy_idx]
+    results = np.zeros(len(seeds), dtype=RESULT_DTYPE)
+    for result_idx, seed in enumerate(seeds):
+        if hasattr(policy, 'reset'):
+            policy.reset()
+        snake = _worker_state['snake_cls'](board_size=_worker_state['board_size'], random_seed=seed,
+                                           sprite_location=SPRITE_PATH)
+        n_steps = play_game(snake, policy, max_moves=_worker_state['max_moves'], strict=False)
+        cause = get_outcome(snake, is_stalled=True)  # a game still going was stopped by `play_game`
+        results[result_idx] = (policy_idx, seed, len(snake.body_locations) + 1, n_steps, CAUSES.index(cause))
+    return results.tobytes()
+
+
+def load_results(results_path) -> np.ndarray:
+    """Reads a results file, dropping a partly written last record (from a run that was killed mid-write)"""
+    results_path = Path(results_path)
+    n_records = results_path.stat().st_size // RESULT_DTYPE.itemsize
+    with open(results_path, 'r+b') as results_file:
+        results_file.truncate(n_records * RESULT_DTYPE.itemsize)
+    return np.fromfile(results_path, dtype=RESULT_DTYPE, count=n_records)
+
+
+class TournamentStats():
+    """Running statistics of every policy. Scores are kept as a histogram (scores can't be higher than the
+    number of cells), so the mean, spread and percentiles are exact without keeping every game."""
+
+    def __init__(self, policy_specs, n_cells) -> None:
+        self.policy_specs = list(policy_specs)
+        self.score_histograms = np.zeros((len(policy_specs), n_cells + 1), dtype=np.int64)
+        self.cause_counts = np.zeros((len(policy_specs), len(CAUSES)), dtype=np.int64)
+        self.total_steps = np.zeros(len(policy_specs), dtype=np.int64)
+        return None
+
+    @property
+    def n_games(self) -> int:
+        return int(self.cause_counts.sum())
+
+    def update(self, results: np.ndarray):
+        policies = results['policy'].astype(np.intp)
+        np.add.at(self.score_histograms, (policies, results['score'].astype(np.intp)), 1)
+        np.add.at(self.cause_counts, (policies, results['cause'].astype(np.intp)), 1)
+        np.add.at(self.total_steps, policies, results['steps'].astype(np.int64))
+        return None
+
+    def get_policy_summary(self, policy_idx) -> dict:
+        histogram = self.score_histograms[policy_idx]
+        n_games = int(histogram.sum())
+        if n_games == 0:
+            return dict(games=0)
+        scores = np.arange(len(histogram))
+        mean_score = float((histogram * scores).sum() / n_games)
+        cumulative = np.cumsum(histogram)
+        summary = dict(games=n_games,
+                       mean_score=mean_score,
+                       std_score=float(np.sqrt((histogram * (scores - mean_score) ** 2).sum() / n_games)),
+                       min_score=int(scores[histogram > 0][0]),
+                       max_score=int(scores[histogram > 0][-1]))
+        for percentile in (10, 50, 90):
+            summary[f'p{percentile}_score'] = int(np.searchsorted(cumulative, percentile / 100 * n_games))
+        summary['mean_steps'] = float(self.total_steps[policy_idx] / n_games)
+        summary['win_rate'] = float(self.cause_counts[policy_idx, CAUSES.index('won')] / n_games)
+        summary['causes'] = dict(zip(CAUSES, self.cause_counts[policy_idx].tolist()))
+        return summary
+
+    def get_summary(self) -> dict:
+        return {policy_spec: self.get_policy_summary(policy_idx) for policy_idx, policy_spec in enumerate(self.policy_specs)}
+
+
+def make_jobs(n_policies, seeds, batch_size, finished_games=frozenset()) -> list:
+    """`(policy index, seeds)` batches of every game that isn't in `finished_games` yet"""
+    jobs = []
+    for policy_idx in range(n_policies):
+        remaining_seeds = [seed for seed in seeds if (policy_idx, seed) not in finished_games]
+        jobs += [(policy_idx, remaining_seeds[start:start + batch_size])
+                 for start in range(0, len(remaining_seeds), batch_size)]
+    return jobs
+
+
+def run_tournament(policy_specs, seeds, results_path, board_size=(16, 16), max_moves=None, n_workers=None,
+                   batch_size=32, report=None) -> TournamentStats:
+    """Plays every policy on every seed (resuming from `results_path` if it exists) and returns the statistics.
+    `report(stats, n_total)` is called after every finished batch."""
+    results_path = Path(results_path)
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    manifest_path = manifest_path_for(results_path)
+    settings = dict(policies=list(policy_specs), board_size=list(board_size), max_moves=max_moves)
+    stats = TournamentStats(policy_specs, board_size[0] * board_size[1])
+
+    finished_games = set()
+    if results_path.exists() and manifest_path.exists():
+        with open(manifest_path) as manifest_file:
+            previous_settings = json.load(manifest_file)['settings']
+        if previous_settings != settings:
+            raise ValueError(f'{results_path} was made with different settings ({previous_settings}), '
+                             f'use another results file')
+        finished_results = load_results(results_path)
+        stats.update(finished_results)
+        finished_games = set(zip(finished_results['policy'].tolist(), finished_results['seed'].tolist()))
+    elif results_path.exists():
+        raise ValueError(f'{results_path} has no manifest ({manifest_path.name}), so it can\'t be resumed')
+
+    seeds = list(seeds)
+    n_total = len(policy_specs) * len(seeds)
+    jobs = make_jobs(len(policy_specs), seeds, batch_size, finished_games)
+
+    def save_checkpoint():
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(dict(settings=settings, n_games=stats.n_games, summary=stats.get_summary()), manifest_file, indent=2)
+        return None
+
+    save_checkpoint()
+    next_checkpoint_time = time.monotonic() + CHECKPOINT_INTERVAL_S
+    try:
+        with open(results_path, 'ab') as results_file, multiprocessing.Pool(
+                n_workers, initializer=_init_worker, initargs=(policy_specs, board_size, max_moves)) as pool:
+            for packed_results in pool.imap_unordered(_play_batch, jobs):
+                results_file.write(packed_results)
+                results_file.flush()
+                stats.update(np.frombuffer(packed_results, dtype=RESULT_DTYPE))
+                if report is not None:
+                    report(stats, n_total)
+                if time.monotonic() >= next_checkpoint_time:
+                    save_checkpoint()
+                    next_checkpoint_time = time.monotonic() + CHECKPOINT_INTERVAL_S
+    finally:
+        save_checkpoint()
+    return stats
+
+
+def print_progress(stats, n_total):
+    print(f'\r{stats.n_games:,}/{n_total:,} games', end='', flush=True)
+    return None
+
+
+def print_summary(summary):
+    for policy_spec, policy_summary in summary.items():
+        if policy_summary['games'] == 0:
+            continue
+        causes = ', '.join(f'{cause} {count}' for cause, count in policy_summary['causes'].items() if count)
+        print(f"{policy_spec:>14}  {policy_summary['games']:>8,} games  score {policy_summary['mean_score']:8.1f}"
+              f" ± {policy_summary['std_score']:<7.1f} (median {policy_summary['p50_score']})"
+              f"  {policy_summary['mean_steps']:>10,.0f} steps/game  {policy_summary['win_rate']:6.1%} won  ({causes})")
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--policies', nargs='+', default=['hamiltonian'],
+                        help=f"policies to evaluate: {', '.join(SOLVERS)}, or module:factory")
+    parser.add_argument('--seeds', type=int, default=1000, help='number of seeded games per policy')
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--board-size', type=int, nargs=2, default=(16, 16), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--max-moves', type=int, default=None, help='stop a game after this many moves')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--batch-size', type=int, default=32, help='games per job sent to a worker')
+    parser.add_argument('--results', type=Path, default=Path('tournament.results'),
+                        help='results file, resumed if it exists (the manifest goes next to it as .json)')
+    args = parser.parse_args()
+    unknown_policies = [spec for spec in args.policies if ':' not in spec and spec not in SOLVERS]
+    if unknown_policies:
+        parser.error(f"unknown policies: {', '.join(unknown_policies)}")
+
+    seeds = range(args.first_seed, args.first_seed + args.seeds)
+    start_time = time.perf_counter()
+    try:
+        stats = run_tournament(args.policies, seeds, args.results, board_size=args.board_size,
+                               max_moves=args.max_moves, n_workers=args.workers, batch_size=args.batch_size,
+                               report=print_progress)
+    except KeyboardInterrupt:
+        print(f'\ninterrupted, run the same command again to resume from {args.results}')
+        return None
+    except ValueError as error:
+        parser.error(str(error))
+    print(f'\nfinished in {time.perf_counter() - start_time:.1f}s')
+    print_summary(stats.get_summary())
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Headless, batched snake engine.
+
+`VecSnake` steps many independent games at once using stacked NumPy arrays. The rules are the same
+as `Snake.update_from_new_move` in `pygame-snake.py` (walls and body kill, the apple grows the snake,
+reversing straight into the neck is rejected), but nothing here touches pygame so it can be used
+as a training environment on machines without a display.
+"""
+from typing import Optional, Sequence
+
+import numpy as np
+
+# Action ids, ordered clockwise so that the reverse of action `a` is always `(a + 2) % 4`
+ACTIONS = ('up', 'right', 'down', 'left')
+ACTION_TO_ID = {action: action_id for action_id, action in enumerate(ACTIONS)}
+ACTION_DELTAS = np.array([[0, -1], [1, 0], [0, 1], [-1, 0]], dtype=np.int64)
+NO_ACTION = -1  # "keep going in the current direction", i.e. what `Game.run_game` does when no key is pressed
+
+APPLE_REWARD = 1.0
+DEATH_REWARD = -1.0
+_REJECTION_ROUNDS = 4  # random draws tried before falling back to an exact scan of the free cells
+
+
+class VecSnake():
+    """`n_games` snake games stepped in lock-step.
+
+    Every game keeps its state in a row of the stacked arrays below:
+        heads        (n_games, 2)           head (x, y)
+        bodies       (n_games, W*H)         ring buffer of flat body cells, tail first
+        body_starts  (n_games,)             ring buffer index of the tail
+        body_lengths (n_games,)             number of body parts (the score is `body_lengths + 1`)
+        occupancy    (n_games, W, H)        True where the head or a body part is
+        apples       (n_games,)             flat apple cell
+    Observations are `(n_games, 3, W, H)` uint8 boards encoded exactly like `Snake.board`.
+    """
+
+    def __init__(self, n_games: int, board_size=(16, 16), random_seed: Optional[int] = 42) -> None:
+        self.n_games = n_games
+        self.board_size = tuple(board_size)
+        self.n_cells = self.board_size[0] * self.board_size[1]
+        self.rng = np.random.default_rng(random_seed)
+
+        self.heads = np.zeros([n_games, 2], dtype=np.int64)
+        self.bodies = np.zeros([n_games, self.n_cells], dtype=np.int64)
+        self.body_starts = np.zeros(n_games, dtype=np.int64)
+        self.body_lengths = np.zeros(n_games, dtype=np.int64)
+        self.occupancy = np.zeros([n_games, *self.board_size], dtype=bool)
+        self.apples = np.zeros(n_games, dtype=np.int64)
+        self.previous_moves = np.full(n_games, NO_ACTION, dtype=np.int64)
+        self.steps = np.zeros(n_games, dtype=np.int64)
+        self.observations = np.zeros([n_games, 3, *self.board_size], dtype=np.uint8)
+
+        # filled in by `step` for the games that just finished (before they were reset)
+        self.won = np.zeros(n_games, dtype=bool)
+        self.final_scores = np.zeros(n_games, dtype=np.int64)
+        self.move_was_valid = np.zeros(n_games, dtype=bool)
+
+        self.reset()
+
+    def reset(self, game_idxs: Optional[Sequence[int]] = None) -> np.ndarray:
+        """Resets the given games (all of them by default) to the `Snake.__init__` starting position"""
+        game_idxs = np.arange(self.n_games) if game_idxs is None else np.asarray(game_idxs, dtype=np.int64)
+        if game_idxs.size == 0:
+            return self.observations
+        width, height = self.board_size
+        start_head = np.array([width // 2, height // 2])
+        start_apple = self._to_flat(width // 2 + 2, height // 2 + 2)
+
+        self.heads[game_idxs] = start_head
+        self.body_starts[game_idxs] = 0
+        self.body_lengths[game_idxs] = 0
+        self.apples[game_idxs] = start_apple
+        self.previous_moves[game_idxs] = NO_ACTION
+        self.steps[game_idxs] = 0
+
+        self.occupancy[game_idxs] = False
+        self.occupancy[game_idxs, start_head[0], start_head[1]] = True
+        self.observations[game_idxs] = 0
+        self.observations[game_idxs, :, start_head[0], start_head[1]] = 255
+        apple_x, apple_y = np.divmod(start_apple, height)
+        self.observations[game_idxs, 0, apple_x, apple_y] = 255
+        return self.observations
+
+    def step(self, actions):
+        """Applies one action per game (an id from `ACTIONS`, or `NO_ACTION` to keep going).
+
+        Returns `(observations, rewards, dones)`. Games that died or filled the board are reset
+        automatically, so the returned observation of a done game is the first frame of its next game;
+        `final_scores` and `won` hold the outcome of the games that just ended.
+        """
+        actions = np.asarray(actions, dtype=np.int64).reshape(self.n_games)
+        actions = np.where(actions == NO_ACTION, self.previous_moves, actions)
+        rewards = np.zeros(self.n_games, dtype=np.float32)
+        dones = np.zeros(self.n_games, dtype=bool)
+        self.won[:] = False
+
+        # reversing into the neck (and having no direction at all) is rejected, exactly like in `Snake`
+        reversing = (self.previous_moves != NO_ACTION) & (actions == (self.previous_moves + 2) % 4)
+        self.move_was_valid = (actions != NO_ACTION) & ~reversing
+        movers = np.flatnonzero(self.move_was_valid)
+        if movers.size == 0:
+            return self.observations, rewards, dones
+        move_ids = actions[movers]
+        self.previous_moves[movers] = move_ids
+        self.steps[movers] += 1
+
+        old_heads = self.heads[movers]
+        new_heads = old_heads + ACTION_DELTAS[move_ids]
+        width, height = self.board_size
+
+        # Death: off the board, or into a body part (the tail still counts since it moves afterwards)
+        in_bounds = ((new_heads[:, 0] >= 0) & (new_heads[:, 0] < width)
+                     & (new_heads[:, 1] >= 0) & (new_heads[:, 1] < height))
+        hit_body = np.zeros(movers.size, dtype=bool)
+        hit_body[in_bounds] = self.occupancy[movers[in_bounds], new_heads[in_bounds, 0], new_heads[in_bounds, 1]]
+        died = ~in_bounds | hit_body
+        dead_games = movers[died]
+        self.final_scores[dead_games] = self.body_lengths[dead_games] + 1
+        rewards[dead_games] = DEATH_REWARD
+        dones[dead_games] = True
+
+        # Survivors move: the previous head joins the body, and the tail leaves unless the snake ate
+        survived = ~died
+        games = movers[survived]
+        old_heads, new_heads = old_heads[survived], new_heads[survived]
+        new_flat = self._to_flat(new_heads[:, 0], new_heads[:, 1])
+        ate = new_flat == self.apples[games]
+
+        shrinking = games[~ate]
+        vacated = old_heads[~ate].copy()
+        has_body = self.body_lengths[shrinking] > 0
+        with_body = shrinking[has_body]
+        tail_flat = self.bodies[with_body, self.body_starts[with_body]]
+        vacated[has_body] = np.stack(np.divmod(tail_flat, height), axis=-1)
+        self.body_starts[with_body] = (self.body_starts[with_body] + 1) % self.n_cells
+        self.body_lengths[with_body] -= 1
+        self.occupancy[shrinking, vacated[:, 0], vacated[:, 1]] = False
+        self.observations[shrinking, :, vacated[:, 0], vacated[:, 1]] = 0
+
+        # the previous head becomes the newest body part (a body-less snake that didn't eat stays body-less)
+        grows_body = ate.copy()
+        grows_body[~ate] = has_body
+        joining = games[grows_body]
+        write_idx = (self.body_starts[joining] + self.body_lengths[joining]) % self.n_cells
+        self.bodies[joining, write_idx] = self._to_flat(old_heads[grows_body, 0], old_heads[grows_body, 1])
+        self.body_lengths[joining] += 1
+
+        self.heads[games] = new_heads
+        self.occupancy[games, new_heads[:, 0], new_heads[:, 1]] = True
+        self.observations[games, :, new_heads[:, 0], new_heads[:, 1]] = 255
+
+        eaters = games[ate]
+        rewards[eaters] = APPLE_REWARD
+        filled = self.body_lengths[eaters] + 1 == self.n_cells
+        winners = eaters[filled]
+        self.won[winners] = True
+        self.final_scores[winners] = self.n_cells
+        dones[winners] = True
+        self._spawn_apples(eaters[~filled])
+
+        self.reset(np.flatnonzero(dones))
+        return self.observations, rewards, dones
+
+    @property
+    def scores(self) -> np.ndarray:
+        """Current score of every game, computed like `Game.calculate_score`"""
+        return self.body_lengths + 1
+
+    def body_locations(self, game_idx: int) -> list:
+        """The body of one game as `[x, y]` pairs ordered tail first, like `Snake.body_locations`"""
+        offsets = (self.body_starts[game_idx] + np.arange(self.body_lengths[game_idx])) % self.n_cells
+        xs, ys = np.divmod(self.bodies[game_idx, offsets], self.board_size[1])
+        return [[int(x), int(y)] for x, y in zip(xs, ys)]
+
+    def _to_flat(self, x, y):
+        return x * self.board_size[1] + y
+
+    def _spawn_apples(self, game_idxs: np.ndarray) -> None:
+        """Places a new apple on a free cell of every game in `game_idxs`"""
+        pending = game_idxs
+        flat_occupancy = self.occupancy.reshape(self.n_games, self.n_cells)
+        # cheap while the boards are mostly empty: draw any cell and redraw the ones that landed on the snake
+        for _ in range(_REJECTION_ROUNDS):
+            if pending.size == 0:
+                return None
+            cells = self.rng.integers(0, self.n_cells, size=pending.size)
+            is_free = ~flat_occupancy[pending, cells]
+            self._place_apples(pending[is_free], cells[is_free])
+            pending = pending[~is_free]
+        # the remaining boards are crowded, so pick uniformly among the free cells directly
+        for game_idx in pending:
+            free_cells = np.flatnonzero(~flat_occupancy[game_idx])
+            self._place_apples(np.array([game_idx]), free_cells[self.rng.integers(0, free_cells.size, size=1)])
+        return None
+
+    def _place_apples(self, game_idxs: np.ndarray, cells: np.ndarray) -> None:
+        self.apples[game_idxs] = cells
+        apple_x, apple_y = np.divmod(cells, self.board_size[1])
+        self.observations[game_idxs, 0, apple_x, apple_y] = 255
+        return None
@@ -0,0 +1,273 @@
+"""Gameplay video export that doesn't stall the game loop.
+
+`VideoExporter.add_frame` copies a rendered frame (the screen Surface, or a `(width, height, 3)` array) into a
+ring buffer of `buffer_size` preallocated frames and returns right away. A background thread takes the frames
+out in order and encodes them as one of `FORMATS`:
+
+    mp4    an H.264 video, encoded by a local ffmpeg that the raw RGB frames are piped to
+    gif    an animated GIF, also encoded by ffmpeg (with a palette made from the whole video)
+    png    a folder of numbered PNG files, saved with pygame (no ffmpeg needed)
+
+When the encoder falls behind and the buffer is full, the `overflow` policy decides what happens to a new
+frame: 'drop' skips it, so the game never waits (frames are lost instead), and 'block' waits for a free slot,
+so no frame is lost (for offline rendering, where waiting costs nothing).
+
+Recorded games (see `replay.py`) are rendered offline, as fast as they can be encoded, with `render_replay`:
+
+    python video_export.py game_saves/replays/*.snakereplay --format mp4 --out-dir videos
+"""
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from pathlib import Path
+
+import numpy as np
+import pygame
+
+from replay import ReplayPlayer
+
+FORMATS = ('mp4', 'gif', 'png')
+OVERFLOW_POLICIES = ('drop', 'block')
+# ffmpeg output options per format (the input is always raw RGB frames on stdin)
+FFMPEG_OUTPUT_ARGS = {
+    # H.264 needs even frame sizes, so odd sizes are padded by a pixel
+    'mp4': ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-preset', 'veryfast'],
+    'gif': ['-vf', 'split[frames][palette_input];[palette_input]palettegen[palette];[frames][palette]paletteuse'],
+}
+
+logger = logging.getLogger('snake')
+
+
+def get_video_format(output_path) -> str:
+    """The format of `output_path` from its suffix (a path without a known suffix is a PNG folder)"""
+    suffix = Path(output_path).suffix.lower().lstrip('.')
+    return suffix if suffix in FORMATS else 'png'
+
+
+class FrameRingBuffer():
+    """A fixed number of preallocated `(width, height, 3)` frames, filled by one thread and emptied by another.
+
+    `put` copies a frame into the next free slot. `get` returns the oldest frame as a view of its slot, which
+    stays reserved until `release` is called, so the reader never has to copy it.
+    """
+
+    def __init__(self, frame_size, capacity) -> None:
+        self.frames = np.zeros((capacity, *frame_size, 3), dtype=np.uint8)
+        self.capacity = capacity
+        self.first_slot = 0
+        self.n_filled = 0
+        self.is_closed = False
+        self.condition = threading.Condition()
+        return None
+
+    def put(self, frame, block=False) -> bool:
+        """Copies `frame` in. If the buffer is full, returns False right away, or with `block` waits for a slot"""
+        with self.condition:
+            while self.n_filled == self.capacity and block and not self.is_closed:
+                self.condition.wait()
+            if self.n_filled == self.capacity or self.is_closed:
+                return False
+            slot = (self.first_slot + self.n_filled) % self.capacity
+        # only this thread writes, and the reader doesn't touch the slot before `n_filled` counts it
+        if isinstance(frame, pygame.Surface):
+            pygame.pixelcopy.surface_to_array(self.frames[slot], frame)
+        else:
+            np.copyto(self.frames[slot], frame)
+        with self.condition:
+            self.n_filled += 1
+            self.condition.notify_all()
+        return True
+
+    def get(self):
+        """Waits for the oldest frame and returns it, or returns None once the buffer is closed and empty"""
+        with self.condition:
+            while self.n_filled == 0 and not self.is_closed:
+                self.condition.wait()
+            if self.n_filled == 0:
+                return None
+            return self.frames[self.first_slot]
+
+    def release(self):
+        """Frees the slot of the frame that `get` returned"""
+        with self.condition:
+            self.first_slot = (self.first_slot + 1) % self.capacity
+            self.n_filled -= 1
+            self.condition.notify_all()
+        return None
+
+    def close(self):
+        """No more frames are put in, the frames that are in can still be taken out"""
+        with self.condition:
+            self.is_closed = True
+            self.condition.notify_all()
+        return None
+
+
+class FFmpegEncoder():
+    """Pipes raw frames to a local ffmpeg process, which writes `output_path`"""
+
+    def __init__(self, output_path, frame_size, fps, video_format) -> None:
+        ffmpeg_path = shutil.which('ffmpeg')
+        if ffmpeg_path is None:
+            raise FileNotFoundError(f'{video_format} export needs ffmpeg on the PATH (or use the png format)')
+        width, height = frame_size
+        command = [ffmpeg_path, '-loglevel', 'error', '-y',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+                   *FFMPEG_OUTPUT_ARGS[video_format], str(output_path)]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        # frames come in as (width, height), ffmpeg wants rows, so each frame is transposed into this buffer first
+        self.row_major_frame = np.zeros((height, width, 3), dtype=np.uint8)
+        return None
+
+    def write(self, frame):
+        np.copyto(self.row_major_frame, frame.swapaxes(0, 1))
+        self.process.stdin.write(self.row_major_frame.data)
+        return None
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f'ffmpeg exited with code {self.process.returncode}')
+        return None
+
+
+class PngSequenceEncoder():
+    """Saves every frame as `output_dir/frame-000000.png`, `frame-000001.png`, ..."""
+
+    def __init__(self, output_dir, frame_size) -> None:
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.surface = pygame.Surface(frame_size)
+        self.n_frames = 0
+        return None
+
+    def write(self, frame):
+        pygame.surfarray.blit_array(self.surface, frame)
+        pygame.image.save(self.surface, str(self.output_dir / f'frame-{self.n_frames:06d}.png'))
+        self.n_frames += 1
+        return None
+
+    def close(self):
+        return None
+
+
+def make_encoder(output_path, frame_size, fps, video_format):
+    if video_format == 'png':
+        return PngSequenceEncoder(output_path, frame_size)
+    return FFmpegEncoder(output_path, frame_size, fps, video_format)
+
+
+class VideoExporter():
+    """Encodes the frames given to `add_frame` to `output_path` on a background thread.
+
+    Call `close()` (or use it as a context manager) to encode the frames that are still buffered and finish
+    the file. If the encoder fails, `add_frame` and `close()` raise a RuntimeError from then on.
+    """
+
+    def __init__(self, output_path, frame_size, fps=30, video_format=None, buffer_size=64, overflow='drop') -> None:
+        self.output_path = Path(output_path)
+        self.video_format = get_video_format(output_path) if video_format is None else video_format
+        if self.video_format not in FORMATS:
+            raise ValueError(f'Unknown video format {self.video_format!r}, expected one of {FORMATS}')
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}')
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        self.frame_size = tuple(frame_size)
+        self.overflow = overflow
+        self.encoder = make_encoder(self.output_path, self.frame_size, fps, self.video_format)
+        self.buffer = FrameRingBuffer(self.frame_size, buffer_size)
+        self.n_frames = 0  # frames that were encoded
+        self.n_dropped_frames = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._encode_frames, name='video-encoder', daemon=True)
+        self.thread.start()
+        return None
+
+    def add_frame(self, frame) -> bool:
+        """Queues a copy of `frame` (a Surface or a `(width, height, 3)` array) for encoding.
+        Returns False if it was dropped."""
+        if self.error is None and self.buffer.put(frame, block=self.overflow == 'block'):
+            return True
+        if self.error is not None:
+            raise RuntimeError(f'Video export to {self.output_path} failed') from self.error
+        self.n_dropped_frames += 1
+        return False
+
+    def _encode_frames(self):
+        while (frame := self.buffer.get()) is not None:
+            try:
+                self.encoder.write(frame)
+            except Exception as error:  # e.g. a broken ffmpeg pipe, or a pygame.error from saving a PNG
+                logger.error(f'Video export to {self.output_path} failed: {error}')
+                self.error = error
+                self.buffer.close()  # stops `add_frame` from waiting on frames that will never be taken out
+                break
+            finally:
+                self.buffer.release()
+            self.n_frames += 1
+        return None
+
+    def close(self):
+        self.buffer.close()
+        self.thread.join()
+        if self.error is None:
+            self.encoder.close()
+        elif self.video_format != 'png':
+            self.encoder.process.kill()
+        if self.n_dropped_frames:
+            logger.info(f'Video export dropped {self.n_dropped_frames} of {self.n_frames + self.n_dropped_frames} frames')
+        if self.error is not None:
+            raise RuntimeError(f'Video export to {self.output_path} failed') from self.error
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def render_replay(replay_path, output_path, video_format=None, fps=30, sprite_size=(16, 16), buffer_size=64,
+                  **snake_kwargs) -> int:
+    """Renders a recorded game, one frame per move, without a display and as fast as it can be encoded.
+    Returns the number of frames."""
+    player = ReplayPlayer(replay_path, sprite_size=sprite_size, **snake_kwargs)
+    snake = player.new_snake()
+    frame_size = (player.replay.board_size[0] * sprite_size[0], player.replay.board_size[1] * sprite_size[1])
+    with VideoExporter(output_path, frame_size, fps=fps, video_format=video_format, buffer_size=buffer_size,
+                       overflow='block') as exporter:
+        exporter.add_frame(snake.prepare_board_for_displaying(frame_size))
+        for snake in player.iter_ticks(snake):
+            exporter.add_frame(snake.prepare_board_for_displaying(frame_size))
+    return exporter.n_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('replays', nargs='+', type=Path, help='.snakereplay files to render')
+    parser.add_argument('--format', default='mp4', help=f"one of {', '.join(FORMATS)}")
+    parser.add_argument('--out-dir', type=Path, default=Path('videos'))
+    parser.add_argument('--fps', type=int, default=30, help='frames (i.e. moves) per second of video')
+    parser.add_argument('--sprite-size', type=int, default=16, help='size of a cell in the video, in px')
+    parser.add_argument('--sprites', type=Path, default=Path(__file__).with_name('snake-sprites.png'))
+    args = parser.parse_args()
+    if args.format not in FORMATS:
+        parser.error(f"unknown format {args.format}, expected one of {', '.join(FORMATS)}")
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    for replay_path in args.replays:
+        output_path = args.out_dir / (replay_path.stem if args.format == 'png' else f'{replay_path.stem}.{args.format}')
+        try:
+            n_frames = render_replay(replay_path, output_path, video_format=args.format, fps=args.fps,
+                                     sprite_size=(args.sprite_size, args.sprite_size), sprite_location=args.sprites)
+        except FileNotFoundError as error:  # there is no ffmpeg to encode mp4/gif with
+            parser.error(str(error))
+        print(f'{replay_path} -> {output_path} ({n_frames} frames)')
+    return None
+
+
+if __name__ == '__main__':
+    main()